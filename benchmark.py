@@ -0,0 +1,598 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from contextlib import redirect_stdout
+from urllib.parse import urlsplit, parse_qs
+from time import perf_counter
+from datetime import date
+import subprocess
+import tempfile
+import threading
+import argparse
+import random
+import json
+import sys
+import os
+import re
+
+import tableextractor
+from tableextractor import Cell, Row, TABLE_DIVS, LABEL_CLASSES
+
+def timed(func, repeat):
+    """Call func() `repeat` times, return (best time in seconds, last result)"""
+    best = float("inf")
+    result = None
+
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func()
+        best = min(best, perf_counter() - start)
+
+    return best, result
+
+def print_results(title, results):
+    """Print a table with (name, seconds) results, relative to the first one"""
+    print(title)
+    reference = results[0][1]
+
+    for name, seconds in results:
+        print(f"  {name:<24} {seconds * 1000:>9.2f} ms  {reference / seconds:>6.2f}×")
+
+# EXTRACTOR BENCHMARK #
+
+def extract_tables_bs4(page):
+    """Extract timetable data the way HokkaidoRailGTFS used to,
+    with a whole BeautifulSoup tree. Returns (tables, error).
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page, "html.parser")
+    tables = {}
+
+    for div_id in TABLE_DIVS:
+        div = soup.find("div", id=div_id)
+
+        if div is None:
+            continue
+
+        tables[div_id] = []
+
+        for tr in div.find_all("tr"):
+            row = Row()
+
+            for td in tr.find_all("td"):
+                row.cells.append(Cell(td.get_text().strip(), td.get("style", ""),
+                                      td.get("onclick", "")))
+
+            for cls in LABEL_CLASSES:
+                elem = tr.find(lambda i: cls in i.get("class", []))
+                if elem:
+                    row.labels[cls] = elem.get_text().strip()
+
+            tables[div_id].append(row)
+
+    error = soup.find("div", class_="error-message")
+    return tables, error.get_text() if error else ""
+
+# Pages on which tableextractor has to behave differently than a naive parser:
+# (description, page, expected cell texts of timeBody rows)
+EXTRACTOR_CASES = [
+    ("<script> and <style> in a cell",
+     '<div id="timeBody"><table><tr><td>12<script>var x = "<td>";</script>34'
+     '<style>td { color: red }</style></td><td>5</td></tr></table></div>',
+     [["1234", "5"]]),
+    ("nested table",
+     '<div id="timeBody"><table><tr><td>a<table><tr><td>b</td></tr><tr><td>c</td></tr>'
+     '</table></td><td>d</td></tr><tr><td>e</td></tr></table></div>',
+     [["abc", "d"], ["e"]]),
+    ("nested table without closing tags",
+     '<div id="timeBody"><table><tr><td>a<table><tr><td>b<td>c</table>d<td>e<tr><td>f'
+     '</table></div>',
+     [["abcd", "e"], ["f"]]),
+]
+
+def check_extractor_cases(backends):
+    """Make sure all extractors handle EXTRACTOR_CASES"""
+    for backend in backends:
+        for description, page, expected in EXTRACTOR_CASES:
+            rows = tableextractor.extract_tables(page, backend).tables["timeBody"]
+
+            if [[cell.text for cell in row.cells] for row in rows] != expected:
+                raise AssertionError(f"{backend} extractor fails on a {description}")
+
+def bench_extractor(args):
+    """Compare BeautifulSoup scraping with tableextractor on saved vtime.php pages"""
+    pages = []
+    for path in args.pages:
+        with open(path, "r", encoding="utf-8") as f:
+            pages.append(f.read())
+
+    backends = ["stdlib"]
+    if tableextractor.lxml_etree is not None:
+        backends.insert(0, "lxml")
+
+    check_extractor_cases(backends)
+
+    # Make sure all extractors agree
+    expected = [extract_tables_bs4(page) for page in pages]
+
+    for backend in backends:
+        for path, page, (tables, error) in zip(args.pages, pages, expected):
+            result = tableextractor.extract_tables(page, backend)
+
+            if result.tables != tables or result.error != error:
+                raise AssertionError(f"{backend} extractor differs from BeautifulSoup on {path}")
+
+    results = [("beautifulsoup", timed(lambda: [extract_tables_bs4(p) for p in pages],
+                                       args.repeat)[0])]
+
+    for backend in backends:
+        seconds, _ = timed(lambda: [tableextractor.extract_tables(p, backend) for p in pages],
+                           args.repeat)
+        results.append((backend, seconds))
+
+    print_results(f"Extracting {len(pages)} page(s), {sum(map(len, pages))} characters",
+                  results)
+
+# TIME BENCHMARK #
+
+class LegacyTime:
+    """The Time class HokkaidoRailGTFS used to have, kept for comparison"""
+    def __init__(self, seconds):
+        self.m, self.s = divmod(int(seconds), 60)
+        self.h, self.m = divmod(self.m, 60)
+
+    def __str__(self): return f"{self.h:0>2}:{self.m:0>2}:{self.s:0>2}"
+    def __int__(self): return self.h * 3600 + self.m * 60 + self.s
+    def __lt__(self, other): return self.__int__() < int(other)
+    def __gt__(self, other): return self.__int__() > int(other)
+
+    @classmethod
+    def from_str(cls, string):
+        value = re.sub(r"\D", "", string)
+        if len(value) == 3:
+            return cls(int(value[0]) * 3600 + int(value[1:]) * 60)
+        else:
+            return cls(int(value[:2]) * 3600 + int(value[2:]) * 60)
+
+def bench_time(args):
+    """Compare parsing, comparing and formatting times with the old Time class"""
+    from trains import parse_time, format_time
+
+    rnd = random.Random(0)
+    cells = [f"{rnd.randint(4, 25) % 24}:{rnd.randint(0, 59):0>2}" for _ in range(args.cells)]
+
+    def parse_legacy(): return [LegacyTime.from_str(i) for i in cells]
+    def parse_new(): return [parse_time(i) for i in cells]
+
+    legacy_times, new_times = parse_legacy(), parse_new()
+    assert [int(i) for i in legacy_times] == new_times
+
+    def compare_legacy(): return sum(1 for i in legacy_times if i > 79200 or i < 14400)
+    def compare_new(): return sum(1 for i in new_times if i > 79200 or i < 14400)
+
+    def format_legacy(): return [str(i) for i in legacy_times]
+    def format_new(): return [format_time(i) for i in new_times]
+
+    assert format_legacy() == format_new()
+
+    for name, legacy, new in [("parse", parse_legacy, parse_new),
+                              ("compare", compare_legacy, compare_new),
+                              ("format", format_legacy, format_new)]:
+        print_results(f"{name.capitalize()} {len(cells)} times",
+                      [("legacy Time", timed(legacy, args.repeat)[0]),
+                       ("int time", timed(new, args.repeat)[0])])
+
+# UNTENBI BENCHMARK #
+
+def bench_untenbi(args):
+    """Compare throughput of the parsec and hand-written untenbi parsers"""
+    import parsec
+    import untenbiparser
+
+    with open(args.corpus, "r", encoding="utf8") as f:
+        corpus = [i.rstrip("\n") for i in f if i.strip() and not i.startswith("#")]
+
+    disagreements = untenbiparser.compare_parsers(args.corpus)
+    if disagreements:
+        raise AssertionError(f"untenbi parsers disagree on: {disagreements}")
+
+    def run(parser):
+        for text in corpus:
+            try:
+                parser(text)
+            except (parsec.ParseError, KeyError, ValueError):
+                pass
+
+    results = [(name, timed(lambda: run(untenbiparser.PARSERS[name]), args.repeat)[0])
+               for name in ("parsec", "fast")]
+
+    print_results(f"Parsing {len(corpus)} descriptions", results)
+
+    for name, seconds in results:
+        print(f"  {name:<24} {len(corpus) / seconds:>9.0f} descriptions/s")
+
+# OFFLINE BENCHMARK #
+
+def load_manifest(fixtures_dir):
+    """Return the manifest.json saved by `benchmark.py record`"""
+    path = os.path.join(fixtures_dir, "manifest.json")
+
+    # Recorded pages aren't kept in the repository
+    if not os.path.exists(path):
+        sys.exit(f"No recorded pages in {fixtures_dir}, "
+                 "run `python3 benchmark.py record` first (this needs network access)")
+
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class FixtureServer(ThreadingHTTPServer):
+    """A local stand-in for jrhokkaidonorikae.com and the holidays CSV,
+    serving pages recorded by `benchmark.py record` from `fixtures_dir`:
+    /vtime.php?s=ID is read from ID.html, and /syukujitsu.csv from syukujitsu.csv.
+    """
+    def __init__(self, fixtures_dir):
+        super().__init__(("127.0.0.1", 0), FixtureHandler)
+        self.fixtures_dir = fixtures_dir
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def vtime_url(self):
+        return f"http://127.0.0.1:{self.server_port}/vtime.php"
+
+    @property
+    def holidays_url(self):
+        return f"http://127.0.0.1:{self.server_port}/syukujitsu.csv"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+
+        if url.path == "/vtime.php":
+            name = parse_qs(url.query).get("s", [""])[0] + ".html"
+            content_type = "text/html; charset=utf-8"
+        elif url.path == "/syukujitsu.csv":
+            name = "syukujitsu.csv"
+            content_type = "text/csv; charset=shift_jis"
+        else:
+            name = None
+
+        path = os.path.join(self.server.fixtures_dir, name) if name else None
+
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, "rb") as f:
+            body = f.read()
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def record_fixtures(args):
+    """Download pages used by the offline benchmark from the live websites"""
+    from hokkaidorail import HokkaidoRailGTFS, HOLIDAYS_URL
+
+    os.makedirs(args.fixtures, exist_ok=True)
+
+    gtfs = HokkaidoRailGTFS(max_per_second=args.rate_limit, output=None)
+    gtfs.load_routes_info()
+
+    timetables = list(dict.fromkeys(gtfs.timetable_ids()))
+    kukyu_counts = {}
+
+    for idx, (ttable_id, _) in enumerate(timetables):
+        print(f"Recording timetable {ttable_id} ({idx + 1}/{len(timetables)})")
+        page = gtfs.fetcher.fetch_timetable(ttable_id)
+        kukyu_counts[ttable_id] = page.count("区休")
+
+        with open(os.path.join(args.fixtures, f"{ttable_id}.html"), "w", encoding="utf-8") as f:
+            f.write(page)
+
+    with open(os.path.join(args.fixtures, "syukujitsu.csv"), "wb") as f:
+        f.write(gtfs.fetcher.get_bytes(HOLIDAYS_URL))
+
+    # Timetables for the get_trains benchmark
+    split_route = next(i for i in gtfs.routes if i.get("split") is True)
+    kukyu_id = max(kukyu_counts, key=kukyu_counts.get)
+    representative = {
+        "split_route": [split_route["web_down"], 0],
+        "express": [gtfs.expresses["web_down"][0], 0],
+        "kukyu": [kukyu_id, next(d for i, d in timetables if i == kukyu_id)],
+    }
+
+    with open(os.path.join(args.fixtures, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"recorded": date.today().isoformat(), "timetables": timetables,
+                   "representative": representative}, f, indent=2)
+
+    gtfs.fetcher.close()
+    gtfs.compress()
+
+def bench_get_trains(gtfs, manifest, repeat, results):
+    """Time HokkaidoRailGTFS.get_trains() on the representative timetables"""
+    from hokkaidorail import TimetableParser
+
+    gtfs.timetable_parser = TimetableParser(gtfs.calendar_data.get("section_changing"))
+
+    for name, (ttable_id, dir_id) in manifest["representative"].items():
+        seconds, trains = timed(lambda: gtfs.get_trains(ttable_id, dir_id), repeat)
+        results[f"get_trains.{name}.seconds"] = seconds
+        results[f"get_trains.{name}.trains_per_second"] = len(trains) / seconds
+
+def bench_untenbi_fixtures(gtfs, manifest, repeat, results):
+    """Time the default untenbi parser on all service descriptions from the fixtures
+    which aren't described in data/calendars.yaml. Returns all descriptions.
+    """
+    import parsec
+    from untenbiparser import PARSERS
+
+    parse_untenbi = PARSERS["fast"]
+
+    descriptions = set()
+    for ttable_id, dir_id in manifest["timetables"]:
+        descriptions.update(i.active_days for i in gtfs.get_trains(ttable_id, dir_id))
+
+    to_parse = sorted(i for i in descriptions if i not in gtfs.calendar_data["regular"]
+                      and i not in gtfs.calendar_data["other"])
+
+    def run():
+        for text in to_parse:
+            try:
+                parse_untenbi(text)
+            except (parsec.ParseError, KeyError, ValueError):
+                pass
+
+    seconds, _ = timed(run, repeat)
+    results["parse_untenbi.seconds"] = seconds
+    results["parse_untenbi.descriptions_per_second"] = len(to_parse) / seconds
+
+    return sorted(descriptions)
+
+def bench_calendars(gtfs, descriptions, repeat, results):
+    """Time assigning service_ids to all descriptions and writing calendar_dates.txt"""
+    from feedwriter import FeedWriter, MemorySink
+
+    def run():
+        gtfs.services.clear()
+        gtfs.service_masks.clear()
+        gtfs.incorrect_services.clear()
+        gtfs.writer = FeedWriter([MemorySink()])
+
+        for desc in descriptions:
+            gtfs.get_service_id(desc)
+
+        # Unparsable descriptions would make calendars() fail
+        gtfs.incorrect_services.clear()
+        gtfs.calendars()
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        seconds, _ = timed(run, repeat)
+
+    results["calendars.seconds"] = seconds
+
+def bench_full(server, full_repeat, results):
+    """Time the whole HokkaidoRailGTFS.parse() against the stand-in server"""
+    from hokkaidorail import HokkaidoRailGTFS
+
+    best = None
+
+    for _ in range(full_repeat):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics_path = os.path.join(tmp_dir, "metrics.json")
+
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                start = perf_counter()
+                HokkaidoRailGTFS.parse(max_per_second=0, vtime_url=server.vtime_url,
+                                       holidays_url=server.holidays_url,
+                                       output=os.path.join(tmp_dir, "feed.zip"),
+                                       metrics=metrics_path)
+                seconds = perf_counter() - start
+
+            with open(metrics_path, "r", encoding="utf-8") as f:
+                metrics = json.load(f)
+
+        if best is None or seconds < best[0]:
+            best = seconds, metrics
+
+    seconds, metrics = best
+    results["full.seconds"] = seconds
+    results["full.trains_per_second"] = metrics["tables"]["trips.txt"]["rows"] / seconds
+    results["full.stop_times_per_second"] = \
+        metrics["tables"]["stop_times.txt"]["rows"] / seconds
+
+    for stage, values in metrics["stages"].items():
+        results[f"full.stage.{stage}.seconds"] = values["seconds"]
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Print results next to the baseline.
+    Returns names of results worse than the baseline by more than `tolerance`.
+    """
+    regressions = []
+
+    for name, value in results.items():
+        old = baseline.get(name)
+
+        if old is None or old == 0:
+            print(f"  {name:<44} {value:>14.4f}")
+            continue
+
+        # Throughput should go up, everything else (seconds) down
+        higher_is_better = "per_second" in name
+        change = value / old - 1
+        worse = -change if higher_is_better else change
+        marker = "  REGRESSION" if worse > tolerance else ""
+
+        if marker:
+            regressions.append(name)
+
+        print(f"  {name:<44} {value:>14.4f}  (baseline {old:.4f}, {change:+.1%}){marker}")
+
+    return regressions
+
+def bench_offline(args):
+    """Benchmark parsing & the whole pipeline on recorded pages, without network access"""
+    from hokkaidorail import HokkaidoRailGTFS
+
+    manifest = load_manifest(args.fixtures)
+    manifest["timetables"] = [tuple(i) for i in manifest["timetables"]]
+    results = {}
+
+    with FixtureServer(args.fixtures) as server:
+        # The stand-in server doesn't need any rate limiting
+        gtfs = HokkaidoRailGTFS(max_per_second=0, vtime_url=server.vtime_url,
+                                holidays_url=server.holidays_url, output=None)
+        gtfs.load_calendar_data()
+
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            gtfs.prepare_calendars()
+            bench_get_trains(gtfs, manifest, args.repeat, results)
+            descriptions = bench_untenbi_fixtures(gtfs, manifest, args.repeat, results)
+
+        bench_calendars(gtfs, descriptions, args.repeat, results)
+        gtfs.fetcher.close()
+
+        if not args.skip_full:
+            bench_full(server, args.full_repeat, results)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    elif not args.save_baseline:
+        print(f"No baseline in {args.baseline}, save one with --save-baseline")
+
+    print(f"Offline benchmark on fixtures recorded {manifest['recorded']}")
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results as the new baseline to {args.baseline}")
+
+    elif regressions:
+        print(f"{len(regressions)} result(s) regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+def scale_routes(path, scale):
+    """Write a copy of data/routes.yaml to `path`, with every route and
+    express timetable listed `scale` times
+    """
+    import yaml
+
+    with open("data/routes.yaml", "r", encoding="utf8") as f:
+        data = yaml.safe_load(f)
+
+    data["routes"] = data["routes"] * scale
+    data["expresses"]["web_down"] = data["expresses"]["web_down"] * scale
+    data["expresses"]["web_up"] = data["expresses"]["web_up"] * scale
+
+    with open(path, "w", encoding="utf8") as f:
+        yaml.safe_dump(data, f, allow_unicode=True)
+
+def bench_memory(args):
+    """Check that peak memory usage doesn't grow with the amount of timetables"""
+    load_manifest(args.fixtures)
+    results = []
+
+    with FixtureServer(args.fixtures) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in args.scales:
+            routes_path = os.path.join(tmp_dir, f"routes_{scale}.yaml")
+            metrics_path = os.path.join(tmp_dir, f"metrics_{scale}.json")
+            scale_routes(routes_path, scale)
+
+            # Peak RSS only goes up, so every run needs a fresh process
+            subprocess.run(
+                [sys.executable, "hokkaidorail.py", "--routes-file", routes_path,
+                 "--vtime-url", server.vtime_url, "--holidays-url", server.holidays_url,
+                 "--rate-limit", "0", "--pages-in-flight", str(args.pages_in_flight),
+                 "-o", os.path.join(tmp_dir, "feed.zip"), "--metrics", metrics_path],
+                check=True, stdout=subprocess.DEVNULL,
+            )
+
+            with open(metrics_path, "r", encoding="utf-8") as f:
+                metrics = json.load(f)
+
+            results.append((scale, len(metrics["timetables"]), metrics["peak_rss_mib"]))
+
+    print("Peak memory usage by amount of timetables")
+    for scale, timetables, peak in results:
+        print(f"  ×{scale:<3} {timetables:>5} timetables  {peak:>9.2f} MiB")
+
+    growth = results[-1][2] / results[0][2] - 1
+    print(f"Growth from ×{results[0][0]} to ×{results[-1][0]}: {growth:+.1%}")
+
+    if growth > args.tolerance:
+        print(f"Peak memory grew by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="HokkaidoRailGTFS benchmarks")
+    arg_parser.add_argument("-n", "--repeat", type=int, default=5,
+                            help="how many times each benchmark is repeated (default: 5)")
+    subparsers = arg_parser.add_subparsers(dest="benchmark", required=True)
+
+    extractor_parser = subparsers.add_parser("extractor", help=bench_extractor.__doc__)
+    extractor_parser.add_argument("pages", nargs="+", help="saved vtime.php pages")
+    extractor_parser.set_defaults(func=bench_extractor)
+
+    time_parser = subparsers.add_parser("time", help=bench_time.__doc__)
+    time_parser.add_argument("--cells", type=int, default=100_000,
+                             help="amount of timetable cells (default: 100000)")
+    time_parser.set_defaults(func=bench_time)
+
+    untenbi_parser = subparsers.add_parser("untenbi", help=bench_untenbi.__doc__)
+    untenbi_parser.add_argument("--corpus", default="data/untenbi_corpus.txt",
+                                help="file with descriptions (default: data/untenbi_corpus.txt)")
+    untenbi_parser.set_defaults(func=bench_untenbi)
+
+    record_parser = subparsers.add_parser("record", help=record_fixtures.__doc__)
+    record_parser.add_argument("--fixtures", default="benchmarks/fixtures",
+                               help="where to save pages (default: benchmarks/fixtures)")
+    record_parser.add_argument("--rate-limit", type=float, default=2,
+                               help="maximum amount of requests per second (default: 2)")
+    record_parser.set_defaults(func=record_fixtures)
+
+    offline_parser = subparsers.add_parser("offline", help=bench_offline.__doc__)
+    offline_parser.add_argument("--fixtures", default="benchmarks/fixtures",
+                                help="directory with recorded pages (default: benchmarks/fixtures)")
+    offline_parser.add_argument("--baseline", default="benchmarks/baseline.json",
+                                help="results to compare against "
+                                     "(default: benchmarks/baseline.json)")
+    offline_parser.add_argument("--save-baseline", action="store_true",
+                                help="save the results as the new baseline")
+    offline_parser.add_argument("--tolerance", type=float, default=0.1,
+                                help="allowed slowdown before reporting a regression "
+                                     "(default: 0.1, 10%%)")
+    offline_parser.add_argument("--full-repeat", type=int, default=1,
+                                help="how many times the whole pipeline is run (default: 1)")
+    offline_parser.add_argument("--skip-full", action="store_true",
+                                help="don't run the whole pipeline")
+    offline_parser.set_defaults(func=bench_offline)
+
+    memory_parser = subparsers.add_parser("memory", help=bench_memory.__doc__)
+    memory_parser.add_argument("--fixtures", default="benchmarks/fixtures",
+                               help="directory with recorded pages (default: benchmarks/fixtures)")
+    memory_parser.add_argument("--scales", type=int, nargs="+", default=[1, 2, 4],
+                               help="how many times every timetable is listed in each run "
+                                    "(default: 1 2 4)")
+    memory_parser.add_argument("--pages-in-flight", type=int, default=8,
+                               help="passed to hokkaidorail.py (default: 8)")
+    memory_parser.add_argument("--tolerance", type=float, default=0.1,
+                               help="allowed growth of peak memory between the smallest and "
+                                    "the largest scale (default: 0.1, 10%%)")
+    memory_parser.set_defaults(func=bench_memory)
+
+    args = arg_parser.parse_args()
+    args.func(args)
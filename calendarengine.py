@@ -0,0 +1,101 @@
+from datetime import timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class CalendarEngine:
+    """Computes on which days within a date range services are active.
+
+    The range is expanded once into per-day weekdays (holidays behave like sundays)
+    and (month, day) tuples. Active days of a service are then expressed as a mask
+    over that range - a NumPy bool array if NumPy is available,
+    a Python int bitset otherwise.
+    """
+    def __init__(self, start, end, holidays, use_numpy=None):
+        if use_numpy is None:
+            use_numpy = numpy is not None
+
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+        self.use_numpy = use_numpy
+        self.date_strings = [i.strftime("%Y%m%d") for i in days]
+
+        # ↓ all holidays behave like sundays
+        weekdays = [6 if i in holidays else i.weekday() for i in days]
+        month_days = [(i.month, i.day) for i in days]
+
+        if use_numpy:
+            self.weekdays = numpy.array(weekdays, dtype=numpy.uint8)
+            self.month_days = numpy.array([m * 100 + d for m, d in month_days],
+                                          dtype=numpy.uint16)
+
+        else:
+            self.weekday_masks = [0] * 7
+            self.month_day_masks = {}
+
+            for idx, (weekday, month_day) in enumerate(zip(weekdays, month_days)):
+                self.weekday_masks[weekday] |= 1 << idx
+                self.month_day_masks[month_day] = self.month_day_masks.get(month_day, 0) \
+                    | 1 << idx
+
+    def mask(self, service_data, pattern_days):
+        """Return the mask of days, on which a service is active.
+
+        `service_data` is a dict as returned by parse_untenbi
+        (with optional start, end, removed & added keys), and
+        `pattern_days` a list of 7 0/1 values for each weekday.
+
+        A day is active if it's between start and end, isn't removed,
+        and is either added or matches pattern_days.
+        """
+        start = service_data.get("start", (1, 1))
+        end = service_data.get("end", (12, 31))
+        removed = service_data.get("removed", ())
+        added = service_data.get("added", ())
+
+        if self.use_numpy:
+            in_range = (self.month_days >= start[0] * 100 + start[1]) \
+                & (self.month_days <= end[0] * 100 + end[1])
+
+            is_removed = numpy.isin(self.month_days, [m * 100 + d for m, d in removed])
+            is_added = numpy.isin(self.month_days, [m * 100 + d for m, d in added])
+            in_pattern = numpy.array(pattern_days, dtype=bool)[self.weekdays]
+
+            return in_range & ~is_removed & (is_added | in_pattern)
+
+        in_range = self.month_days_mask(lambda i: start <= i <= end)
+        is_removed = self.month_days_mask(lambda i: i in removed)
+        is_added = self.month_days_mask(lambda i: i in added)
+
+        in_pattern = 0
+        for weekday, active in enumerate(pattern_days):
+            if active == 1:
+                in_pattern |= self.weekday_masks[weekday]
+
+        return in_range & ~is_removed & (is_added | in_pattern)
+
+    def month_days_mask(self, predicate):
+        """Return a mask of days whose (month, day) satisfy the predicate"""
+        mask = 0
+        for month_day, month_day_mask in self.month_day_masks.items():
+            if predicate(month_day):
+                mask |= month_day_mask
+        return mask
+
+    def key(self, mask):
+        """Return a hashable value identifying the mask"""
+        return mask.tobytes() if self.use_numpy else mask
+
+    def active_dates(self, mask):
+        """Return a list of YYYYMMDD strings of days active in the mask"""
+        if self.use_numpy:
+            return [self.date_strings[i] for i in numpy.flatnonzero(mask)]
+
+        dates = []
+        while mask:
+            lowest_bit = mask & -mask
+            dates.append(self.date_strings[lowest_bit.bit_length() - 1])
+            mask ^= lowest_bit
+        return dates
@@ -0,0 +1,176 @@
+from array import array
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Export format → (module it needs, path suffix)
+FORMATS = {
+    "npz": ("numpy", ".columns.npz"),
+    "arrow": ("pyarrow", "_arrow"),
+    "parquet": ("pyarrow", "_parquet"),
+}
+
+# table → {column: array typecode (or None for string columns)}
+TABLES = {
+    "trips": {
+        "trip": "i", "route_id": "i", "service": "i", "trip_headsign": None,
+        "trip_short_name": None, "direction_id": "b", "block_id": None, "shape_id": None,
+    },
+    "stop_times": {
+        "trip": "i", "stop_sequence": "i", "stop": "i", "arrival_time": "i",
+        "departure_time": "i", "shape_dist_traveled": "d",
+    },
+    "calendar_dates": {
+        "service": "i", "date": "i",
+    },
+}
+
+NUMPY_TYPES = {"i": "int32", "b": "int8", "d": "float64"}
+
+class Codes:
+    """Assigns consecutive integer codes to values, in order of their first appearance"""
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+
+        return code
+
+class ColumnarFeed:
+    """trips, stop_times and calendar_dates kept as columns, for export to
+    NumPy .npz, Arrow (Feather) or Parquet files, which can be memory-mapped.
+
+    stop_ids, trip_ids and service_ids are integer-coded: the `trip`, `stop` and `service`
+    columns hold indices into lists of the original IDs. Times are seconds since midnight,
+    dates YYYYMMDD integers and a missing shape_dist_traveled is NaN.
+    """
+    def __init__(self, export_format):
+        module, _ = FORMATS[export_format]
+
+        if (module == "numpy" and numpy is None) or (module == "pyarrow" and pyarrow is None):
+            raise ImportError(f"{module} is required to export the feed as {export_format}")
+
+        self.export_format = export_format
+
+        self.stops = Codes()
+        self.trips = Codes()
+        self.services = Codes()
+
+        self.tables = {table: {column: array(typecode) if typecode else []
+                               for column, typecode in columns.items()}
+                       for table, columns in TABLES.items()}
+
+    def add_trip(self, gtfs_trip, gtfs_times):
+        """Add a trip and its stop_times, as returned by HokkaidoRailGTFS.convert_to_gtfs()"""
+        trip = self.trips.code(gtfs_trip["trip_id"])
+        trips = self.tables["trips"]
+
+        trips["trip"].append(trip)
+        trips["route_id"].append(gtfs_trip["route_id"])
+        trips["service"].append(self.services.code(str(gtfs_trip["service_id"])))
+        trips["trip_headsign"].append(gtfs_trip["trip_headsign"])
+        trips["trip_short_name"].append(gtfs_trip["trip_short_name"])
+        trips["direction_id"].append(gtfs_trip["direction_id"])
+        trips["block_id"].append(str(gtfs_trip["block_id"]))
+        trips["shape_id"].append(gtfs_trip["shape_id"])
+
+        times = self.tables["stop_times"]
+        times["trip"].extend([trip] * len(gtfs_times))
+        times["stop_sequence"].extend(i[1] for i in gtfs_times)
+        times["stop"].extend(self.stops.code(str(i[2])) for i in gtfs_times)
+        times["arrival_time"].extend(i[3] for i in gtfs_times)
+        times["departure_time"].extend(i[4] for i in gtfs_times)
+        times["shape_dist_traveled"].extend(float("nan") if i[5] == "" else i[5]
+                                            for i in gtfs_times)
+
+    def add_service_dates(self, service_id, dates):
+        """Add dates (YYYYMMDD strings) on which a service is active"""
+        service = self.services.code(str(service_id))
+        calendar_dates = self.tables["calendar_dates"]
+
+        calendar_dates["service"].extend([service] * len(dates))
+        calendar_dates["date"].extend(int(i) for i in dates)
+
+    def dictionaries(self):
+        """Return lists of IDs behind integer-coded columns"""
+        return {"stop_id": self.stops.values, "trip_id": self.trips.values,
+                "service_id": self.services.values}
+
+    def save(self, path):
+        """Export the feed to `path`: an .npz file, or a directory
+        with TABLE.arrow or TABLE.parquet files
+        """
+        if self.export_format == "npz":
+            self.save_npz(path)
+        else:
+            self.save_arrow(path, self.export_format)
+
+    def save_npz(self, path):
+        """Save all columns into a single, uncompressed .npz file,
+        with TABLE.COLUMN keys, and lists of IDs under stop_id, trip_id & service_id
+        """
+        arrays = {}
+
+        for table, columns in self.tables.items():
+            for column, values in columns.items():
+                typecode = TABLES[table][column]
+                arrays[f"{table}.{column}"] = \
+                    numpy.frombuffer(values, dtype=NUMPY_TYPES[typecode]) if typecode \
+                    else numpy.array(values, dtype=str)
+
+        for name, values in self.dictionaries().items():
+            arrays[name] = numpy.array(values, dtype=str)
+
+        with open(path, "wb") as f:
+            numpy.savez(f, **arrays)
+
+    def save_arrow(self, path, export_format):
+        """Save every table into a separate Arrow (Feather) or Parquet file.
+        Integer-coded columns become dictionary arrays, named after the original ID columns.
+        """
+        os.makedirs(path, exist_ok=True)
+
+        arrow_types = {"i": pyarrow.int32(), "b": pyarrow.int8(), "d": pyarrow.float64()}
+        coded = {"trip": "trip_id", "stop": "stop_id", "service": "service_id"}
+        dictionaries = {k: pyarrow.array(v, pyarrow.string())
+                        for k, v in self.dictionaries().items()}
+
+        for table, columns in self.tables.items():
+            arrays = {}
+
+            for column, values in columns.items():
+                typecode = TABLES[table][column]
+                values = pyarrow.array(values, arrow_types[typecode] if typecode
+                                       else pyarrow.string())
+
+                if column in coded:
+                    column = coded[column]
+                    values = pyarrow.DictionaryArray.from_arrays(values, dictionaries[column])
+
+                arrays[column] = values
+
+            arrow_table = pyarrow.table(arrays)
+
+            if export_format == "arrow":
+                # Uncompressed, so that the files can be memory-mapped
+                pyarrow.feather.write_feather(arrow_table, os.path.join(path, table + ".arrow"),
+                                              compression="uncompressed")
+            else:
+                pyarrow.parquet.write_table(arrow_table, os.path.join(path, table + ".parquet"))
@@ -0,0 +1,84 @@
+import gzip
+import json
+import os
+
+# Fields of trips compared between builds, other than stop_times
+TRIP_FIELDS = ("route_id", "trip_headsign")
+
+class FeedDiff:
+    """Compares trips of the current build with the previous one.
+
+    Sequential trip_ids change between builds, so trips are matched by a natural key:
+    (trip_short_name, service description, direction_id, occurrence),
+    where occurrence tells apart trips which would otherwise have the same key
+    (like parts of a split train). A trip moved to another route is reported as modified.
+
+    Trips of every build are saved (as gzipped JSON) to `state_path`,
+    to be compared against by the next build.
+    """
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.previous = None
+        self.current = {}
+
+        if os.path.exists(state_path):
+            with gzip.open(state_path, "rt", encoding="utf8") as f:
+                self.previous = {tuple(i["key"]): i for i in json.load(f)}
+
+    def add(self, gtfs_trip, service_desc, stop_times):
+        """Remember a trip of the current build.
+        `stop_times` is a list of (stop_id, arrival_time, departure_time).
+        """
+        key = [gtfs_trip["trip_short_name"], service_desc, gtfs_trip["direction_id"], 0]
+
+        while tuple(key) in self.current:
+            key[-1] += 1
+
+        self.current[tuple(key)] = {
+            "key": key,
+            "trip_id": gtfs_trip["trip_id"],
+            "service_id": gtfs_trip["service_id"],
+            **{i: gtfs_trip[i] for i in TRIP_FIELDS},
+            "stop_times": [list(i) for i in stop_times],
+        }
+
+    @staticmethod
+    def changed_fields(old, new):
+        return [i for i in (*TRIP_FIELDS, "stop_times") if old[i] != new[i]]
+
+    def diff(self):
+        """Return a dict with added, removed and modified trips.
+        If there's no previous build, all trips are added.
+        """
+        previous = self.previous or {}
+
+        added = [trip for key, trip in self.current.items() if key not in previous]
+        removed = [{"key": trip["key"], "previous_trip_id": trip["trip_id"]}
+                   for key, trip in previous.items() if key not in self.current]
+        modified = []
+
+        for key, trip in self.current.items():
+            old = previous.get(key)
+            changes = self.changed_fields(old, trip) if old is not None else None
+
+            if changes:
+                modified.append({**trip, "previous_trip_id": old["trip_id"],
+                                 "changed": changes})
+
+        return {
+            "has_previous_build": self.previous is not None,
+            "trips": len(self.current),
+            "added": added,
+            "removed": removed,
+            "modified": modified,
+        }
+
+    def save(self, diff_path):
+        """Write the diff to `diff_path`, and the current build to state_path"""
+        with open(diff_path, "w", encoding="utf8") as f:
+            json.dump(self.diff(), f, ensure_ascii=False, indent=1)
+
+        with gzip.open(self.state_path + ".tmp", "wt", encoding="utf8") as f:
+            json.dump(list(self.current.values()), f, ensure_ascii=False)
+
+        os.replace(self.state_path + ".tmp", self.state_path)
@@ -0,0 +1,256 @@
+from tempfile import SpooledTemporaryFile
+from time import perf_counter
+import zipfile
+import csv
+import shutil
+import io
+import os
+
+# Tables written while another one is streamed into a zip file are kept
+# in memory up to this size, and in a temporary file above it
+SPOOL_SIZE = 16 * 2**20
+
+class SinkFile(io.RawIOBase):
+    """A binary file handed out by sinks.
+    Writes go to `file`, and on close on_close(file) is called.
+    """
+    def __init__(self, file, on_close):
+        self.file = file
+        self.on_close = on_close
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.file.write(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.on_close(self.file)
+
+class TeeFile(io.RawIOBase):
+    """A binary file which writes everything into multiple other files"""
+    def __init__(self, files):
+        self.files = files
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            for f in self.files:
+                f.close()
+
+class TableWriter:
+    """Writes rows of a single table, given as tuples in the order of `columns`.
+
+    Rows are formatted into an in-memory buffer, which is encoded and written
+    to the binary `file` every `chunk_rows` rows. The amount of rows, bytes and
+    time spent writing them is tracked for stats().
+
+    If a `database` (like SQLiteFeed) is given, all rows are also inserted into it.
+    """
+    def __init__(self, name, file, columns, chunk_rows=8192, database=None):
+        self.name = name
+        self.file = file
+        self.chunk_rows = chunk_rows
+        self.database = database
+
+        self.buffer = io.StringIO()
+        self.csv = csv.writer(self.buffer)
+        self.pending = 0
+
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+        self.csv.writerow(columns)
+
+        if self.database is not None:
+            self.database.create(name, columns)
+
+    def writerow(self, row):
+        start = perf_counter()
+        self.csv.writerow(row)
+        self.pending += 1
+        self.rows += 1
+
+        if self.database is not None:
+            self.database.insert(self.name, (row,))
+
+        if self.pending >= self.chunk_rows:
+            self.flush()
+
+        self.seconds += perf_counter() - start
+
+    def writerows(self, rows):
+        start = perf_counter()
+        rows = rows if isinstance(rows, list) else list(rows)
+        self.csv.writerows(rows)
+        self.pending += len(rows)
+        self.rows += len(rows)
+
+        if self.database is not None:
+            self.database.insert(self.name, rows)
+
+        if self.pending >= self.chunk_rows:
+            self.flush()
+
+        self.seconds += perf_counter() - start
+
+    def flush(self):
+        """Write out buffered rows"""
+        data = self.buffer.getvalue().encode("utf8")
+        self.file.write(data)
+        self.bytes += len(data)
+
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.pending = 0
+
+    def close(self):
+        start = perf_counter()
+        self.flush()
+        self.file.close()
+        self.seconds += perf_counter() - start
+
+    def stats(self):
+        """Return a one-line summary of what was written"""
+        rate = self.rows / self.seconds if self.seconds else 0
+        return f"{self.name}: {self.rows} rows, {self.bytes / 2**20:.2f} MiB, " \
+            f"{rate:,.0f} rows/s"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class DirectorySink:
+    """Saves tables as separate files in a directory"""
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def open(self, name):
+        return open(os.path.join(self.path, name), "wb")
+
+    def close(self):
+        pass
+
+class ZipSink:
+    """Streams tables straight into a zip archive.
+
+    Only one entry of a zip file can be written at a time, so tables opened
+    while another one is still open are spooled into a SpooledTemporaryFile,
+    and copied into the archive once nothing else is being written.
+
+    Entries only use ZIP64 extensions if they need them: spooled entries if their
+    size is over the limit, and zipfile raises an error if a streamed one grows over it.
+
+    The archive is created as `path.tmp`, and moved to `path` on close.
+    """
+    def __init__(self, path, compression_level=None):
+        self.path = path
+        self.archive = zipfile.ZipFile(path + ".tmp", "w", zipfile.ZIP_DEFLATED,
+                                       compresslevel=compression_level)
+
+        self.streaming = False
+        self.spooled = []
+
+    def open(self, name):
+        if not self.streaming:
+            self.streaming = True
+            return SinkFile(self.archive.open(name, "w"), self.entry_closed)
+
+        return SinkFile(SpooledTemporaryFile(SPOOL_SIZE),
+                        lambda f: self.spool_closed(name, f))
+
+    def entry_closed(self, entry):
+        entry.close()
+        self.streaming = False
+        self.write_spooled()
+
+    def spool_closed(self, name, spool):
+        self.spooled.append((name, spool))
+        self.write_spooled()
+
+    def write_spooled(self):
+        """Copy finished spooled tables into the archive"""
+        if self.streaming:
+            return
+
+        for name, spool in self.spooled:
+            # Same check as zipfile does for entries of a known size
+            size = spool.seek(0, os.SEEK_END)
+            spool.seek(0)
+
+            with self.archive.open(name, "w",
+                                   force_zip64=size * 1.05 > zipfile.ZIP64_LIMIT) as entry:
+                shutil.copyfileobj(spool, entry, 2**20)
+
+            spool.close()
+
+        self.spooled.clear()
+
+    def close(self):
+        self.archive.close()
+        os.replace(self.path + ".tmp", self.path)
+
+class MemorySink:
+    """Keeps tables in memory, as a dict of name → bytes"""
+    def __init__(self):
+        self.files = {}
+
+    def open(self, name):
+        return SinkFile(io.BytesIO(), lambda f: self.files.__setitem__(name, f.getvalue()))
+
+    def close(self):
+        pass
+
+class FeedWriter:
+    """Writes GTFS tables into one or more sinks (DirectorySink, ZipSink or MemorySink).
+    Tables created with table() are also loaded into `database`, if one is given.
+    """
+    def __init__(self, sinks, database=None):
+        self.sinks = sinks
+        self.database = database
+        self.tables = []
+
+    def open_binary(self, name):
+        """Return a binary file for the `name` table.
+        Everything written to it is passed to all sinks.
+        """
+        files = [sink.open(name) for sink in self.sinks]
+        raw = files[0] if len(files) == 1 else TeeFile(files)
+        return io.BufferedWriter(raw, 2**16)
+
+    def open(self, name, newline=""):
+        """Return a text file for the `name` table"""
+        return io.TextIOWrapper(self.open_binary(name), encoding="utf8", newline=newline)
+
+    def table(self, name, columns):
+        """Return a TableWriter for the `name` table, with a header already written"""
+        table = TableWriter(name, self.open_binary(name), columns, database=self.database)
+        self.tables.append(table)
+        return table
+
+    def stats(self):
+        """Return stats() of all tables created by table()"""
+        return [i.stats() for i in self.tables]
+
+    def close(self):
+        """Finish writing to all sinks (and the database)"""
+        for sink in self.sinks:
+            sink.close()
+
+        if self.database is not None:
+            self.database.close()
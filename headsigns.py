@@ -0,0 +1,90 @@
+from warnings import warn
+import sys
+
+from terminal import STR_WARN, STR_RESET
+
+class HeadsignBuilder:
+    """Builds trip_headsigns from (train type, train name, name suffix, destination),
+    adding their kana and English translations to `to_kana` & `to_english`.
+
+    Every unique headsign is only built (and added to translations) once;
+    later trips get the same, interned string back, and `hits` counts
+    how many trips used every headsign.
+    Missing translations of train types and names are only warned about once.
+    """
+    def __init__(self, type_translation, to_kana, to_english):
+        self.type_translation = type_translation
+        self.to_kana = to_kana
+        self.to_english = to_english
+
+        self.headsigns = {}
+        self.hits = {}
+        self.missing = set()
+
+    def add_type_translation(self, name, name_en, name_kana):
+        """Add a translation of a train type or name.
+        Headsigns built so far are forgotten, as they could have used this translation.
+        """
+        self.type_translation[name] = name_en, name_kana
+        self.headsigns.clear()
+
+    def translate_type(self, name, kind):
+        """Return (name_en, name_kana) of a train type or name"""
+        translation = self.type_translation.get(name)
+
+        if translation is None:
+            if name not in self.missing:
+                self.missing.add(name)
+                warn(STR_WARN + f"Missing translation for train {kind} {name!r}" + STR_RESET)
+
+            return "", ""
+
+        return translation
+
+    def get(self, train_type, train_name, train_name_suffix, dest):
+        """Return the trip_headsign of a train"""
+        key = train_type, train_name, train_name_suffix, dest
+        headsign = self.headsigns.get(key)
+
+        if headsign is None:
+            headsign = self.build(*key)
+            self.headsigns[key] = headsign
+
+        self.hits[key] = self.hits.get(key, 0) + 1
+        return headsign
+
+    def build(self, train_type, train_name, train_name_suffix, dest):
+        """Generate a trip_headsign and its translations"""
+        type_en, type_kana = self.translate_type(train_type, "type")
+        name_en, name_kana = self.translate_type(train_name, "name")
+
+        dest_en = self.to_english[dest]
+        dest_kana = self.to_kana[dest]
+
+        if train_type == train_name:
+            ja_headsign = f"（{train_type}）"
+            en_headsign = f" ({type_en}) "
+            kana_headsign = f"（{type_kana}）"
+
+        elif train_name_suffix:
+            ja_headsign = f'（{train_type}「{train_name}{train_name_suffix}」）'
+            en_headsign = f' ({type_en} "{name_en} {train_name_suffix}") '
+            kana_headsign = f'（{type_kana}「{name_kana}{train_name_suffix}」）'
+
+        else:
+            ja_headsign = f'（{train_type}「{train_name}」）'
+            en_headsign = f' ({type_en} "{name_en}") '
+            kana_headsign = f'（{type_kana}「{name_kana}」）'
+
+        ja_headsign = sys.intern(ja_headsign + dest)
+
+        self.to_kana[ja_headsign] = kana_headsign + dest_kana
+        self.to_english[ja_headsign] = en_headsign + dest_en
+
+        return ja_headsign
+
+    def report(self):
+        """Return a summary of how many trips share headsigns"""
+        trips = sum(self.hits.values())
+        ratio = trips / len(self.hits) if self.hits else 0
+        return f"{trips} trips use {len(self.hits)} headsigns ({ratio:.2f} trips per headsign)"
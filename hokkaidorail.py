@@ -1,12 +1,12 @@
-import xml.etree.ElementTree as etree
 from datetime import date, datetime, timedelta
-from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from time import perf_counter
 from parsec import ParseError
-from bs4 import BeautifulSoup
-from itertools import chain
+from itertools import chain, islice
 from warnings import warn
+import argparse
 import requests
-import zipfile
 import pytz
 import yaml
 import csv
@@ -14,7 +14,24 @@ import os
 import io
 import re
 
-from untenbiparser import parse_untenbi
+from trains import Train, parse_time, format_time
+from untenbiparser import UntenbiCache, PARSERS as UNTENBI_PARSERS
+from pagefetcher import PageFetcher, ResponseCache, VTIME_URL
+from tableextractor import extract_tables, TABLE_DIVS
+from calendarengine import CalendarEngine
+from osmloader import load_osm
+from shapeengine import Shaper
+from stoppatterns import StopPatternRegistry
+from timetablestore import TimetableStore
+from feedwriter import FeedWriter, DirectorySink, ZipSink
+from metrics import Metrics
+from feeddiff import FeedDiff
+from headsigns import HeadsignBuilder
+from routesplitter import RouteSplitter, split_parts
+from columnarfeed import ColumnarFeed, FORMATS as COLUMNAR_FORMATS
+from sqlitefeed import SQLiteFeed
+from stableids import StableIds, ID_STRATEGIES
+from terminal import STR_1UP
 
 # Meta
 
@@ -28,11 +45,25 @@ __email__ = "mikolaj [аt] mkuran.pl"
 OUTPUT_SERVICE_DESC = False
 DEFAULT_AGENCY = "4430001022657"
 
-STR_1UP = "\033[1A\033[K"
-STR_RED = "\033[31m"
-STR_YELLOW = "\033[33m"
-STR_RESET = "\033[0m"
-STR_WARN = STR_RED + "Warning! " + STR_YELLOW
+TRIP_COLUMNS = ("route_id", "trip_id", "service_id", "trip_headsign",
+                "trip_short_name", "direction_id", "block_id", "shape_id")
+
+ROUTE_COLUMNS = ("agency_id", "route_id", "route_short_name", "route_long_name",
+                 "route_type", "route_color", "route_text_color")
+
+SHAPE_COLUMNS = ("shape_id", "shape_pt_sequence", "shape_pt_lat", "shape_pt_lon",
+                 "shape_dist_traveled")
+
+STOP_TIME_COLUMNS = ("trip_id", "stop_sequence", "stop_id", "arrival_time", "departure_time",
+                     "shape_dist_traveled")
+
+# Stages run by HokkaidoRailGTFS.parse(), which can be profiled with --profile
+STAGES = ("agency", "stops", "prepare_shapes", "load_calendar_data", "prepare_calendars",
+          "trains", "calendars", "translations", "feed_info", "compress", "write_diff",
+          "write_columnar")
+
+HOLIDAYS_URL = "https://www8.cao.go.jp/chosei/shukujitsu/syukujitsu.csv"
+HOLIDAYS_FALLBACK_URL = "https://mkuran.pl/moovit/japan-cao-shukujitsu.csv"
 
 # HELPING FUNCTIONS #
 
@@ -48,26 +79,24 @@ def get_text_color(color):
 
     return "000000" if yiq > 128 else "FFFFFF"
 
-def load_holidays(start, end):
+def load_holidays(start, end, fetcher, url=HOLIDAYS_URL):
     """Loads Japan holidays into self.holidays.
     Data comes from Japan's Cabinet Office:
     https://www8.cao.go.jp/chosei/shukujitsu/gaiyou.html
 
     Only holdays within start and end are saved.
+    The CSV file is downloaded with the provided PageFetcher from `url`.
     """
     holidays = set()
 
     try:
-        req = requests.get("https://www8.cao.go.jp/chosei/shukujitsu/syukujitsu.csv")
-        req.raise_for_status()
+        text = fetcher.get(url, encoding="shift-jis")
     except requests.exceptions.SSLError:
         print("! Connection to cao.go.jp raised an SSL Error")
         print("! Fetching a copy of holidays CSV file from mkuran.pl", end="\n\n")
-        req = requests.get("https://mkuran.pl/moovit/japan-cao-shukujitsu.csv")
-        req.raise_for_status()
+        text = fetcher.get(HOLIDAYS_FALLBACK_URL, encoding="shift-jis")
 
-    req.encoding = "shift-jis"
-    buffer = io.StringIO(req.text)
+    buffer = io.StringIO(text)
     reader = csv.DictReader(buffer)
 
     for row in reader:
@@ -80,185 +109,26 @@ def load_holidays(start, end):
     buffer.close()
     return holidays
 
-def has_station(train, look_for_station):
-    """Check if this `train` stops at the given station (by the station name).
-    Returns the index of this station within train["stations"], or
-    if the train does not stop returns -1.
-    """
-    for idx, stoptime in enumerate(train["stations"]):
-        if stoptime["sta"] == look_for_station:
-            return idx
-    return -1
-
-def split_train(train, split_station, a_stations, b_stations):
-    """Splits the train into 2 parts.
-
-    `split_station` should be the station name where the split should occur.
-
-    `a_stations` & `b_stations` should be a collection of station names
-    that identify a train part as belonging to route A or B.
-
-    returns a tuple of part_a, part_b; after splitting the train.
-    part_a & part_b can be None.
-    """
-    idx_of_split = has_station(train, split_station)
-
-    # if split doesn't exist or train starts at or finishes at split:
-    if idx_of_split == -1 or idx_of_split == 0 or idx_of_split == len(train["stations"]) - 1:
-        if any((has_station(train, i) != -1 for i in a_stations)):
-            return train, None
-        elif any((has_station(train, i) != -1 for i in b_stations)):
-            return None, train
-        elif train["trip_name"] == "エアポート" and len(train["stations"]) == 1 \
-                and train["stations"][0]["sta"] == "札幌":
-            # Airport Express stubs left out on Hakodate line timetables
-            return None, None
-        else:
-            raise ValueError(f"train no {train['trip_number']} in should stop at one of: "
-                             f"{split_station} {a_stations} {b_stations}. "
-                             "It's impossible to split this train into correct routes.")
-
-    # otherwise we try to split the train
-    else:
-        part_1 = train.copy()
-        part_1["stations"] = train["stations"][:idx_of_split + 1]
-        part_1["stations"][-1]["dep"] = part_1["stations"][-1]["arr"]
-
-        part_2 = train.copy()
-        part_2["stations"] = train["stations"][idx_of_split:]
-        part_2["stations"][0]["arr"] = part_2["stations"][0]["dep"]
-
-        # part 1 contains any "a" stations → part_1=part_a, part_2=part_b
-        if any((has_station(part_1, i) != -1 for i in a_stations)):
-            return part_1, part_2
-
-        # part 1 contains any "b" stations → part_2=part_a, part_1=part_b
-        elif any((has_station(part_1, i) != -1 for i in b_stations)):
-            return part_2, part_1
-
-        # part 2 contains any "a" stations → part_2=part_a, part_1=part_b
-        elif any((has_station(part_2, i) != -1 for i in a_stations)):
-            return part_2, part_1
+class TimetableParser:
+    """Turns vtime.php pages into lists of Trains.
 
-        # part 2 contains any "b" stations → part_1=part_a, part_2=part_b
-        elif any((has_station(part_2, i) != -1 for i in b_stations)):
-            return part_1, part_2
-
-        else:
-            raise ValueError(f"train no {train['trip_number']} in should stop at one of: "
-                             f"{split_station} {a_stations} {b_stations}. "
-                             "It's impossible to split this train into correct routes.")
-
-class Time:
-    """An object representing a GTFS time value.
-
-    :param seconds: The amount of seconds since midnight.
-    :type secnonds: int
+    `section_changing` is the section_changing mapping from data/calendars.yaml.
+    The parser holds no other state, so it can be sent to worker processes.
     """
-    def __init__(self, seconds):
-        self.m, self.s = divmod(int(seconds), 60)
-        self.h, self.m = divmod(self.m, 60)
-
-    def __str__(self):
-        """Return GTFS-compliant string representation of time
-        """
-        return f"{self.h:0>2}:{self.m:0>2}:{self.s:0>2}"
-
-    def __repr__(self): return "<Time " + self.__str__() + ">"
-    def __int__(self): return self.h * 3600 + self.m * 60 + self.s
-    def __hash__(self): return hash(self.__int__())
-    def __add__(self, other): return Time(self.__int__() + int(other))
-    def __sub__(self, other): return Time(self.__int__() - int(other))
-    def __lt__(self, other): return self.__int__() < int(other)
-    def __le__(self, other): return self.__int__() <= int(other)
-    def __gt__(self, other): return self.__int__() > int(other)
-    def __ge__(self, other): return self.__int__() >= int(other)
-    def __eq__(self, other): return self.__int__() == int(other)
-    def __ne__(self, other): return self.__int__() != int(other)
-
-    @classmethod
-    def from_str(cls, string):
-        value = re.sub(r"\D", "", string)
-
-        if len(value) == 3:
-            return cls(int(value[0]) * 3600 + int(value[1:]) * 60)
-
-        elif len(value) == 4:
-            return cls(int(value[:2]) * 3600 + int(value[2:]) * 60)
-
-        else:
-            raise ValueError(f"invalid string for Time.from_str(), {value} "
-                             f"(should be HHMM or HMM) (passed: {string})")
-
-class HokkaidoRailGTFS:
-    def __init__(self):
-        # Relations between trains
-        self.blocks = {}
-        self.services = {"毎日": 0}
-        self.trip_enumerator = 0
+    def __init__(self, section_changing):
+        self.section_changing = section_changing
 
-        # Route data (data/routes.yaml)
-        self.routes = {}
-        self.expresses = {}
-
-        # Calendar data
-        self.calendar_data = {}
-
-        # Shape generation (todo)
-        self.train_shaper = None
-        self.bus_shaper = None
-
-        # Station name → ID
-        self.bus_stops = {}
-        self.rail_stations = {}
-
-        # File and CSV writers for exporting trains
-        self.file_routes = None
-        self.file_times = None
-        self.file_trips = None
-
-        self.wrtr_routes = None
-        self.wrtr_trips = None
-        self.wrtr_times = None
-
-        # Translations - loaded with agency_name and agency_official_name translations
-        self.type_translation = {}
-
-        self.to_kana = {
-            "JR北海道": "じぇいあーるほっかいどう",
-            "北海道旅客鉄道株式会社": "ほっかいどうりょかくてつどうかぶしきがいしゃ",
-            "道南いさりび鉄道": "どうなんいさりびてつどう",
-            "道南いさりび鉄道株式会社": "どうなんいさりびてつどうかぶしきがいしゃ",
-        }
-
-        self.to_english = {
-            "JR北海道": "JR Hokkaido",
-            "北海道旅客鉄道株式会社": "Hokkaido Railway Company",
-            "道南いさりび鉄道": "South Hokkaido Railway",
-            "道南いさりび鉄道株式会社": "South Hokkaido Railway Company",
-        }
-
-    # DATA SCRAPING FUNCTIONS #
-
-    def parse_web_ekidori(self, div):
+    def parse_web_ekidori(self, table):
         """Parse the left column, `ekidori` and map row_index to data that is stored there
         """
         rows = {}
 
-        for idx, row in enumerate(div.find_all("tr")):
+        for idx, row in enumerate(table):
             # Check row label
-            item_name = row.find(lambda i: "item-name" in i.get("class", []))
-            if item_name:
-                item_name = item_name.get_text().strip()
-            else:
-                item_name = ""
+            item_name = row.labels.get("item-name", "")
 
             # Check if this row is a departure or an arrival
-            dep_arr = row.find(lambda i: "dep-arv" in i.get("class", []))
-            if dep_arr:
-                dep_arr = dep_arr.get_text().strip()
-            else:
-                dep_arr = ""
+            dep_arr = row.labels.get("dep-arv", "")
 
             # Generate row label (switch-case, but Python)
             if item_name == "列車番号":
@@ -284,12 +154,12 @@ class HokkaidoRailGTFS:
 
         return rows
 
-    def parse_web_timeheader(self, div, rows, dir_id):
+    def parse_web_timeheader(self, table, rows, dir_id):
         """Parse the timeHeader and map column_idx to train data
         """
         trains = {}
 
-        for row_idx, row in enumerate(div.find_all("tr")):
+        for row_idx, row in enumerate(table):
             row_data = rows[row_idx]
 
             # Skip row if it has uniteresting data
@@ -297,8 +167,8 @@ class HokkaidoRailGTFS:
                 continue
 
             # Iterate over each column (each representing one train, i guess)
-            for col_idx, cell in enumerate(row.find_all("td")):
-                value = cell.get_text().strip()
+            for col_idx, cell in enumerate(row.cells):
+                value = cell.text
 
                 # Ignore empty values
                 if not value:
@@ -306,41 +176,41 @@ class HokkaidoRailGTFS:
 
                 # Create an empty entry for column, if it's undefined
                 if col_idx not in trains:
-                    trains[col_idx] = {"stations": [], "dir": dir_id}
+                    trains[col_idx] = Train(dir_id)
 
                 # Some additional data derived from train name
                 if row_data == "trip_name":
-                    style = cell.get("style", "")
+                    style = cell.style
 
                     if value == "バス":
-                        trains[col_idx]["type"] = "バス"
+                        trains[col_idx].type = "バス"
                     elif style == "color: #FF0000;":
-                        trains[col_idx]["type"] = "特急"
+                        trains[col_idx].type = "特急"
                     elif style == "color: #008080;":
-                        trains[col_idx]["type"] = "特別快速"
+                        trains[col_idx].type = "特別快速"
                     elif style == "color: #0000CD;":
-                        trains[col_idx]["type"] = "快速"
+                        trains[col_idx].type = "快速"
                     else:
-                        trains[col_idx]["type"] = "普通"
+                        trains[col_idx].type = "普通"
 
-                trains[col_idx][row_data] = value
+                setattr(trains[col_idx], row_data, value)
 
         return trains
 
-    def parse_web_timebody(self, div, rows, trains):
+    def parse_web_timebody(self, table, rows, trains):
         """Parse the timeBody and add time data to trains
         """
         evening = False
 
-        for row_idx, row in enumerate(div.find_all("tr")):
+        for row_idx, row in enumerate(table):
             row_data = rows[row_idx]
 
             # Ignore uninteresting rows
             if not row_data:
                 continue
 
-            for col_idx, cell in enumerate(row.find_all("td")):
-                value = cell.get_text().strip()
+            for col_idx, cell in enumerate(row.cells):
+                value = cell.text
 
                 # Ignore empty values
                 if not value:
@@ -348,7 +218,7 @@ class HokkaidoRailGTFS:
 
                 # Fix for on_click items
                 # If a value is too long JRH creates a popup
-                on_click = cell.get("onclick", "")
+                on_click = cell.onclick
 
                 if on_click:
                     on_click = re.search(
@@ -356,33 +226,33 @@ class HokkaidoRailGTFS:
                         on_click
                     )
 
-                # Also split first_station and last_station to (Station, Time)
+                # Also split first_station and last_station to (Station, seconds since midnight)
                 if on_click and row_data in {"first_station", "last_station"}:
-                    value = (on_click[2], Time.from_str(value))
+                    value = (on_click[2], parse_time(value))
 
                 elif row_data in {"first_station", "last_station"}:
-                    value = (re.sub(r"(\W|\d)", "", value), Time.from_str(value))
+                    value = (re.sub(r"(\W|\d)", "", value), parse_time(value))
 
                 elif on_click:
                     value = on_click[2]
 
                 # Handle 区休 services
                 if row_data == "active_days" and value == "区休":
-                    calendar_key = trains[col_idx - 1]["active_days"]
+                    calendar_key = trains[col_idx - 1].active_days
 
-                    if calendar_key not in self.calendar_data["section_changing"]:
+                    if calendar_key not in self.section_changing:
                         raise ValueError("Key is missing from calendars.yaml→section_changing "
                                          + calendar_key)
 
-                    days_prev, value = self.calendar_data["section_changing"][calendar_key]
+                    days_prev, value = self.section_changing[calendar_key]
 
                     # Previous train's active_days have to be modified
-                    trains[col_idx - 1]["active_days"] = days_prev
+                    trains[col_idx - 1].active_days = days_prev
 
                     del calendar_key, days_prev
 
                 # Avoid time-travelling first_station, last_station pair
-                if row_data == "last_stations" and value[1] < trains[col_idx]["first_station"][1]:
+                if row_data == "last_stations" and value[1] < trains[col_idx].first_station[1]:
                     value = (value[0], value[1] + 86400)
 
                 # This is a row with time info
@@ -396,7 +266,7 @@ class HokkaidoRailGTFS:
                         continue
 
                     # Try to parse the value
-                    value = Time.from_str(value)
+                    value = parse_time(value)
 
                     # Set evening flag after 22:00
                     if (not evening) and value > 79200:
@@ -408,85 +278,295 @@ class HokkaidoRailGTFS:
                         value += 86400
 
                     # Check if we encountered this station earlier, if we did get its index
-                    station_already_listed = [i for i in trains[col_idx]["stations"]
-                                              if i["sta"] == station]
-                    if station_already_listed:
-                        station_already_listed = trains[col_idx]["stations"]\
-                            .index(station_already_listed[0])
-                    else:
-                        station_already_listed = None
+                    station_already_listed = trains[col_idx].station_index.get(station)
 
                     # If the station was listed, overwrite its arr/dep time
                     if station_already_listed is not None and dep_arr == "dep":
-                        trains[col_idx]["stations"][station_already_listed]["dep"] = value
+                        trains[col_idx].stations[station_already_listed].dep = value
 
                     elif station_already_listed is not None and dep_arr == "arr":
-                        trains[col_idx]["stations"][station_already_listed]["arr"] = value
+                        trains[col_idx].stations[station_already_listed].arr = value
 
                     # If not, just add the station to the list
                     else:
-                        trains[col_idx]["stations"].append({
-                            "sta": station,
-                            "arr": value,
-                            "dep": value
-                        })
+                        trains[col_idx].add_station(station, value)
 
                 else:
-                    trains[col_idx][row_data] = value
+                    setattr(trains[col_idx], row_data, value)
 
         return trains
 
-    def get_trains(self, ttable_id, dir_id):
-        """Return train schedules, parsed from jrhokkaidonorike.com
+    def parse_timetable(self, page, ttable_id, dir_id):
+        """Parse a vtime.php page and return a list of its trains
         """
-        print(STR_1UP + f"Requesting page for timetable {ttable_id}")
-        req = requests.get("https://jrhokkaidonorikae.com/vtime/vtime.php",
-                           params={"s": ttable_id, "d": "0"})
-        req.raise_for_status()
-        req.encoding = "utf-8"
-
-        print(STR_1UP + f"Parsing timetable {ttable_id}")
-        soup = BeautifulSoup(req.text, "html.parser")
+        extracted = extract_tables(page)
 
         # Lavender Express may have no trains
-        error = soup.find("div", class_="error-message")
-        error = error.get_text() if error else ""
-
-        if ttable_id in {670, 671} and "(E013)" in error:
+        if ttable_id in {670, 671} and "(E013)" in extracted.error:
             return []
 
-        elif error:
-            raise ValueError(f"website returned an error: {error}")
+        elif extracted.error:
+            raise ValueError(f"website returned an error: {extracted.error}")
+
+        missing_tables = TABLE_DIVS.difference(extracted.tables)
+        if missing_tables:
+            raise ValueError(f"timetable {ttable_id} is missing tables: {missing_tables}")
 
         # First, header
-        row_data = self.parse_web_ekidori(soup.find("div", id="ekidoriHeader"))
-        trains = self.parse_web_timeheader(soup.find("div", id="timeHeader"), row_data, dir_id)
+        row_data = self.parse_web_ekidori(extracted.tables["ekidoriHeader"])
+        trains = self.parse_web_timeheader(extracted.tables["timeHeader"], row_data, dir_id)
 
         # Now, actual timetable
-        row_data = self.parse_web_ekidori(soup.find("div", id="ekidoriBody"))
-        trains = self.parse_web_timebody(soup.find("div", id="timeBody"), row_data, trains)
+        row_data = self.parse_web_ekidori(extracted.tables["ekidoriBody"])
+        trains = self.parse_web_timebody(extracted.tables["timeBody"], row_data, trains)
 
         # Filter train list
-        trains = filter(
-            lambda i: len(i["stations"]) > 0 and i.get("active_days") not in {"時変", "臨停"},
-            trains.values()
+        return [i for i in trains.values()
+                if len(i.stations) > 0 and i.active_days not in {"時変", "臨停"}]
+
+    def parse_timetable_timed(self, page, ttable_id, dir_id):
+        """Return (parse_timetable(…), seconds it took)"""
+        start = perf_counter()
+        trains = self.parse_timetable(page, ttable_id, dir_id)
+        return trains, perf_counter() - start
+
+class HokkaidoRailGTFS:
+    def __init__(self, max_workers=4, max_per_second=5, cache_dir=None, cache_ttl=0,
+                 cache_max_size=100, offline=False, untenbi_parser="fast",
+                 output="hokkaidorail.zip", compression_level=None, keep_dir=None,
+                 processes=1, metrics=None, profile=None, profile_dir=".",
+                 vtime_url=VTIME_URL, holidays_url=HOLIDAYS_URL, diff_state=None,
+                 ids="sequential", pages_in_flight=8, routes_file="data/routes.yaml",
+                 columnar=None, sqlite=False):
+        # Measuring performance
+        self.metrics = Metrics(self.counters, profile_dir)
+        self.metrics_path = metrics
+        self.profile_stage = profile
+
+        # Output GTFS tables, streamed into the zip file (and optionally also to a directory,
+        # and to an SQLite database next to the zip file)
+        sinks = [ZipSink(output, compression_level)] if output else []
+        if keep_dir:
+            sinks.append(DirectorySink(keep_dir))
+
+        self.sqlite_path = os.path.splitext(output or "hokkaidorail.zip")[0] + ".sqlite" \
+            if sqlite else None
+        self.writer = FeedWriter(sinks, SQLiteFeed(self.sqlite_path) if sqlite else None)
+
+        # Comparing trips with the previous build, saving the diff next to the zip file
+        self.feed_diff = FeedDiff(diff_state) if diff_state else None
+        self.diff_path = os.path.splitext(output or "hokkaidorail.zip")[0] + ".diff.json"
+
+        # Columnar copy of trips, stop_times and calendar_dates, exported next to the zip file
+        self.columnar = ColumnarFeed(columnar) if columnar else None
+        self.columnar_path = os.path.splitext(output or "hokkaidorail.zip")[0] \
+            + COLUMNAR_FORMATS[columnar][1] if columnar else None
+
+        # Downloading timetable pages
+        cache = ResponseCache(cache_dir, cache_ttl, cache_max_size * 2**20) if cache_dir else None
+        self.fetcher = PageFetcher(max_workers, max_per_second, cache, offline, vtime_url)
+        self.holidays_url = holidays_url
+
+        # Parsed timetables from previous runs
+        self.timetable_store = TimetableStore(os.path.join(cache_dir, "parsed")) \
+            if cache_dir else None
+
+        # Parsing timetable pages, in a pool of worker processes if processes > 1
+        self.processes = processes
+        self.timetable_parser = None
+        self.parsing = {}
+        self.pool = None
+
+        # Timetables are read ahead of conversion, but only up to pages_in_flight of them
+        # are downloaded (or parsed) and waiting to be converted at any time
+        if pages_in_flight < 1:
+            raise ValueError("pages_in_flight must be at least 1")
+
+        self.pages_in_flight = pages_in_flight
+        self.upcoming = None
+        self.in_flight = deque()
+
+        # Parsed service descriptions, kept between runs if there's a cache_dir
+        self.untenbi_cache = UntenbiCache(os.path.join(cache_dir, "untenbi.pickle")
+                                          if cache_dir else None, untenbi_parser)
+
+        # Pickled data/stops_shapes.osm
+        self.osm_cache_path = os.path.join(cache_dir, "osm.pickle") if cache_dir else None
+        self.osm = None
+
+        # Relations between trains
+        self.blocks = {}
+        self.services = {}
+        self.trip_enumerator = 0
+
+        # With ids="stable", trip_id, service_id and block_id are derived
+        # from content instead of being numbered in order of appearance
+        if ids not in ID_STRATEGIES:
+            raise ValueError(f"unknown id strategy {ids!r}")
+
+        self.stable_ids = ids == "stable"
+        self.trip_ids = StableIds()
+        self.service_ids = StableIds()
+        self.block_ids = StableIds()
+
+        # Route data (data/routes.yaml)
+        self.routes_file = routes_file
+        self.routes = {}
+        self.splitters = []
+        self.expresses = {}
+
+        # Calendar data
+        self.calendar_data = {}
+        self.calendar_engine = None
+        self.service_masks = {}
+        self.incorrect_services = []
+
+        # Shape generation
+        self.train_shaper = None
+        self.bus_shaper = None
+        self.stop_patterns = StopPatternRegistry()
+
+        # Station name → ID
+        self.bus_stops = {}
+        self.rail_stations = {}
+
+        # Table writers for exporting trains
+        self.wrtr_routes = None
+        self.wrtr_trips = None
+        self.wrtr_times = None
+        self.wrtr_shapes = None
+
+        # Translations - loaded with agency_name and agency_official_name translations
+        self.type_translation = {}
+
+        self.to_kana = {
+            "JR北海道": "じぇいあーるほっかいどう",
+            "北海道旅客鉄道株式会社": "ほっかいどうりょかくてつどうかぶしきがいしゃ",
+            "道南いさりび鉄道": "どうなんいさりびてつどう",
+            "道南いさりび鉄道株式会社": "どうなんいさりびてつどうかぶしきがいしゃ",
+        }
+
+        self.to_english = {
+            "JR北海道": "JR Hokkaido",
+            "北海道旅客鉄道株式会社": "Hokkaido Railway Company",
+            "道南いさりび鉄道": "South Hokkaido Railway",
+            "道南いさりび鉄道株式会社": "South Hokkaido Railway Company",
+        }
+
+        # trip_headsigns, built once for every unique combination of train type, name & destination
+        self.headsigns = HeadsignBuilder(self.type_translation, self.to_kana, self.to_english)
+
+    # DATA SCRAPING FUNCTIONS #
+
+    def read_timetable(self, ttable_id, dir_id):
+        """Get the page of a timetable.
+        Returns (timetable_store_key, page, stored_trains); stored_trains is None
+        if this exact page wasn't parsed before.
+        """
+        page = self.fetcher.timetable(ttable_id)
+
+        if self.timetable_store is None:
+            return None, page, None
+
+        key = self.timetable_store.key(page, ttable_id, dir_id,
+                                       self.calendar_data.get("section_changing"))
+        return key, page, self.timetable_store.load(key)
+
+    def start_parsing(self, ttable_id, dir_id):
+        """Get the page of a timetable and start parsing it in the process pool,
+        unless it was parsed before. Returns (timetable_store_key, stored_trains,
+        Future resolving to (list_of_trains, parse_seconds) or None).
+        Progress isn't printed, as this runs ahead of the timetable being converted.
+        """
+        key, page, trains = self.read_timetable(ttable_id, dir_id)
+
+        if trains is not None:
+            return key, trains, None
+
+        return key, None, self.pool.submit(self.timetable_parser.parse_timetable_timed,
+                                           page, ttable_id, dir_id)
+
+    def fill_pipeline(self):
+        """Read ahead of the timetable being converted: keep the next pages_in_flight
+        timetables (from self.upcoming) downloading in the background, and if there's
+        a process pool, the first `processes` of them parsing.
+        Does nothing outside of trains().
+        """
+        if self.upcoming is None:
+            return
+
+        while len(self.in_flight) < self.pages_in_flight:
+            ttable = next(self.upcoming, None)
+
+            if ttable is None:
+                break
+
+            self.in_flight.append(ttable)
+            self.fetcher.prefetch([ttable[0]])
+
+        if self.pool is not None:
+            for ttable in islice(self.in_flight, self.processes):
+                if ttable not in self.parsing:
+                    self.parsing[ttable] = self.start_parsing(*ttable)
+
+    def get_trains(self, ttable_id, dir_id):
+        """Return train schedules, parsed from jrhokkaidonorike.com
+        """
+        # Trains are requested in the order of timetable_ids(),
+        # so this timetable is the first in flight - make room for the next one
+        self.fill_pipeline()
+        if self.in_flight and self.in_flight[0] == (ttable_id, dir_id):
+            self.in_flight.popleft()
+            self.fill_pipeline()
+
+        print(STR_1UP + f"Requesting page for timetable {ttable_id}")
+        parsing = self.parsing.pop((ttable_id, dir_id), None)
+
+        if parsing is not None:
+            key, trains, future = parsing
+        else:
+            key, page, trains = self.read_timetable(ttable_id, dir_id)
+            future = None
+
+        if trains is not None:
+            print(STR_1UP + f"Timetable {ttable_id} unchanged, using stored trains")
+            parse_seconds = None
+
+        else:
+            print(STR_1UP + f"Parsing timetable {ttable_id}")
+            trains, parse_seconds = future.result() if future is not None \
+                else self.timetable_parser.parse_timetable_timed(page, ttable_id, dir_id)
+
+            if key is not None:
+                self.timetable_store.save(key, trains)
+
+            self.metrics.add_time("html_parsing", parse_seconds)
+
+        download = self.fetcher.timetable_stats.get(ttable_id, {})
+        self.metrics.timetable(
+            id=ttable_id,
+            direction=dir_id,
+            download_bytes=download.get("bytes"),
+            download_seconds=download.get("seconds"),
+            parse_seconds=round(parse_seconds, 4) if parse_seconds is not None else None,
+            from_store=parse_seconds is None,
+            trains=len(trains),
         )
 
         return trains
 
     # GTFS CREATION FUNCTIONS #
 
-    @staticmethod
-    def agency():
+    def agency(self):
         """Generate agency.txt & agency_jp.txt
         """
-        f = open("gtfs/agency.txt", "w", encoding="utf8", newline="\r\n")
+        f = self.writer.open("agency.txt", newline="\r\n")
         f.write('agency_id,agency_name,agency_url,agency_timezone,agency_lang\n')
         f.write('4430001022657,"JR北海道","https://www.jrhokkaido.co.jp/",Asia/Tokyo,ja\n')
         f.write('3430001067100,"道南いさりび鉄道","https://www.shr-isaribi.jp/",Asia/Tokyo,ja\n')
         f.close()
 
-        f = open("gtfs/agency_jp.txt", "w", encoding="utf8", newline="\r\n")
+        f = self.writer.open("agency_jp.txt", newline="\r\n")
         f.write('agency_id,agency_official_name,agency_zip_number,agency_address\n')
         f.write('4430001022657,"北海道旅客鉄道株式会社",0608644,'
                 '"北海道札幌市中央区北十一条西１５丁目１番１号"\n')
@@ -496,26 +576,12 @@ class HokkaidoRailGTFS:
     def stops(self):
         """Parse stops from data/stops_shapes.osm
         """
-        with open("gtfs/stops.txt", "w", encoding="utf8", newline="") as f:
-            w = csv.DictWriter(f, ["stop_id", "stop_name", "stop_code", "stop_lat", "stop_lon"])
-            w.writeheader()
-
-            root = etree.parse("data/stops_shapes.osm").getroot()
-
-            for node in root.iterfind("node"):
-                tags = {tag.get("k"): tag.get("v") for tag in node.findall("tag")}
-
-                if tags.get("railway") != "station" and tags.get("highway") != "bus_stop":
-
-                    continue
+        with self.writer.table("stops.txt", ["stop_id", "stop_name", "stop_code",
+                                             "stop_lat", "stop_lon"]) as w:
+            self.osm = load_osm("data/stops_shapes.osm", self.osm_cache_path)
 
-                w.writerow({
-                    "stop_id": tags["id"],
-                    "stop_name": tags["name"],
-                    "stop_code": tags.get("ref", ""),
-                    "stop_lat": node.attrib["lat"],
-                    "stop_lon": node.attrib["lon"],
-                })
+            for _, lat, lon, tags in self.osm.stops:
+                w.writerow((tags["id"], tags["name"], tags.get("ref", ""), lat, lon))
 
                 self.to_kana[tags["name"]] = tags["name:ja_kana"]
                 self.to_english[tags["name"]] = tags["name:en"]
@@ -525,19 +591,37 @@ class HokkaidoRailGTFS:
                 else:
                     self.rail_stations[tags["name"]] = tags["id"]
 
+    def prepare_shapes(self):
+        """Create shapers for trains and replacement buses
+        from ways in data/stops_shapes.osm
+        """
+        self.train_shaper = Shaper(self.osm, lambda tags: tags.get("railway") == "rail", "R")
+        self.bus_shaper = Shaper(self.osm, lambda tags: "highway" in tags, "B")
+
+    def make_shape(self, shaper, stop_ids):
+        """Route the shape of a new stop pattern and write its points to shapes.txt right away.
+        Returns (shape_id, list_of_dist_traveled) or None, as expected by StopPatternRegistry.
+        """
+        with self.metrics.timer("shape_routing"):
+            shape = shaper.shape(stop_ids)
+
+        if shape is None:
+            return None
+
+        shape_id, dists, points = shape
+        self.wrtr_shapes.writerows((shape_id, idx, lat, lon, dist)
+                                   for idx, (lat, lon, dist) in enumerate(points))
+
+        return shape_id, dists
+
     def translations(self):
         """Dump gathered translations to GTFS
         """
-        with open("gtfs/translations.txt", mode="w", encoding="utf8", newline="") as f:
-            w = csv.writer(f)
-            w.writerow(["trans_id", "lang", "translation"])
-
+        with self.writer.table("translations.txt", ["trans_id", "lang", "translation"]) as w:
             for jp, kana in self.to_kana.items():
                 en = self.to_english[jp]
 
-                w.writerow([jp, "ja", jp])
-                w.writerow([jp, "ja-Hrkt", kana])
-                w.writerow([jp, "en", en])
+                w.writerows([(jp, "ja", jp), (jp, "ja-Hrkt", kana), (jp, "en", en)])
 
     def load_calendar_data(self):
         """Load data from data/calendars.yaml
@@ -563,151 +647,163 @@ class HokkaidoRailGTFS:
             if "added" in values:
                 self.calendar_data["other"][desc]["added"] = {tuple(i) for i in values["added"]}
 
-    def process_calendar_data(self):
-        """Process calendar data and return some rules that
-        can be used to create GTFS calendar data.
+    def prepare_calendars(self):
+        """Load holidays and set up the CalendarEngine for the upcoming 365 days
         """
-        service_infos = []
-        incorrect_services = []
+        start = date.today()
+        end = start + timedelta(days=365)
 
-        for service_desc, service_id in self.services.items():
-            service_data, pattern_days = None, None
+        holidays = load_holidays(start, end, self.fetcher, self.holidays_url)
+        self.calendar_engine = CalendarEngine(start, end, holidays)
 
-            try:
-                # Load service pattern
-                if service_desc in self.calendar_data["regular"]:
-                    print(STR_1UP + f"parsing regular calendar: {service_desc}")
+        # Make sure the everyday service gets service_id 0
+        self.get_service_id("毎日")
 
-                    service_data = {}
-                    pattern_days = self.calendar_data["regular"][service_desc]
+    def process_calendar_data(self, service_desc):
+        """Process calendar data of a single service and return
+        a tuple (service_data, pattern_days) that can be used
+        to create GTFS calendar data.
 
-                elif service_desc in self.calendar_data["other"]:
-                    print(STR_1UP + f"parsing calendar manually described: {service_desc}")
+        Raises KeyError or ParseError if the service can't be understood.
+        """
+        # Load service pattern
+        if service_desc in self.calendar_data["regular"]:
+            service_data = {}
+            pattern_days = self.calendar_data["regular"][service_desc]
 
-                    service_data = self.calendar_data["other"][service_desc]
-                    pattern_days = self.calendar_data["regular"][service_data["pattern"]]
+        elif service_desc in self.calendar_data["other"]:
+            service_data = self.calendar_data["other"][service_desc]
+            pattern_days = self.calendar_data["regular"][service_data["pattern"]]
 
-                else:
-                    print(STR_1UP + f"parsing untenbi-parsed calendar: {service_desc} "
-                                    f"(id: {service_id})")
-                    service_data = parse_untenbi.parse(service_desc)
-                    pattern_days = self.calendar_data["regular"][service_data["pattern"]]
+        else:
+            with self.metrics.timer("untenbi_parsing"):
+                service_data = self.untenbi_cache.parse(service_desc)
 
-                service_infos.append(
-                    (service_id, service_desc, service_data, pattern_days)
-                )
+            pattern_days = self.calendar_data["regular"][service_data["pattern"]]
 
-            except (KeyError, ParseError):
+        return service_data, pattern_days
 
-                incorrect_services.append((service_id, service_desc))
+    def get_service_id(self, service_desc):
+        """Return the service_id for a given service description (運転日).
+        Services active on exactly the same days share their service_id.
 
-        if incorrect_services:
-            print("! invalid services found:")
-            for service_id, service_desc in incorrect_services:
-                print(service_desc + " (id: " + str(service_id) + ")")
-
-            raise ValueError("unable to understand some services!")
+        With stable IDs every description gets its own service,
+        with an ID derived from the description itself.
+        """
+        service_id = self.services.get(service_desc)
 
-        return service_infos
+        if service_id is not None:
+            return service_id
 
-    def calendars(self):
-        """Parse all used calendars and save them to calendar_dates.txt
-        """
-        with open("gtfs/calendar_dates.txt", mode="w", encoding="utf8", newline="") as f:
-            if OUTPUT_SERVICE_DESC:
-                header = ["service_id", "service_desc", "date", "exception_type"]
-            else:
-                header = ["service_id", "date", "exception_type"]
+        try:
+            service_data, pattern_days = self.process_calendar_data(service_desc)
 
-            w = csv.DictWriter(f, header)
-            w.writeheader()
+            with self.metrics.timer("calendar_expansion"):
+                mask = self.calendar_engine.mask(service_data, pattern_days)
+                mask_key = self.calendar_engine.key(mask)
 
-            start = date.today()
-            end = start + timedelta(days=365)
+        except (KeyError, ParseError):
+            mask, mask_key = None, ("invalid", service_desc)
 
-            service_infos = self.process_calendar_data()
+        if self.stable_ids:
+            # Which descriptions share a mask depends on the order of trains,
+            # so sharing services would make their IDs unstable
+            mask_key = "desc", service_desc
 
-            print(STR_1UP + "requesting list of holidays")
-            holidays = load_holidays(start, end)
+        if mask_key in self.service_masks:
+            service_id = self.service_masks[mask_key][0]
 
-            print(STR_1UP + "dumping calendar data")
-            for service_id, service_desc, service_data, pattern_days in service_infos:
-                # Iterate over valid day
-                current_day = start
+        elif self.stable_ids:
+            service_id = self.service_ids.make("", service_desc)
+            self.service_masks[mask_key] = service_id, mask, service_desc
 
-                while current_day <= end:
-                    write = False
-                    weekday = 6 if current_day in holidays else current_day.weekday()
-                    # ↑ all holidays behave like sundays
+            if mask is None:
+                self.incorrect_services.append((service_id, service_desc))
 
-                    date_tpl = current_day.month, current_day.day
+        else:
+            service_id = len(self.service_masks)
+            self.service_masks[mask_key] = service_id, mask, service_desc
 
-                    # 1. Ignore day if it's past-end or pre-start
-                    if date_tpl > service_data.get("end", (12, 31)) \
-                            or date_tpl < service_data.get("start", (1, 1)):
-                        write = False
+            if mask is None:
+                self.incorrect_services.append((service_id, service_desc))
 
-                    # 2. Check if this calendar is marked as "removed" for this day
-                    elif date_tpl in service_data.get("removed", set()):
-                        write = False
+        self.services[service_desc] = service_id
+        return service_id
 
-                    # 3. Check if this calendar is marked as "added" for this day
-                    elif date_tpl in service_data.get("added", set()):
-                        write = True
+    def calendars(self):
+        """Save all used calendars to calendar_dates.txt
+        """
+        if self.incorrect_services:
+            print("! invalid services found:")
+            for service_id, service_desc in self.incorrect_services:
+                print(service_desc + " (id: " + str(service_id) + ")")
 
-                    # 4. Check if this calendar is active
-                    elif pattern_days[weekday] == 1:
-                        write = True
+            raise ValueError("unable to understand some services!")
 
-                    # 5. Fallback to disabled
-                    else:
-                        write = False
+        if OUTPUT_SERVICE_DESC:
+            columns = ["service_id", "service_desc", "date", "exception_type"]
+        else:
+            columns = ["service_id", "date", "exception_type"]
 
-                    if write:
-                        row = {
-                            "service_id": service_id,
-                            "date": current_day.strftime("%Y%m%d"),
-                            "exception_type": 1,
-                        }
+        with self.writer.table("calendar_dates.txt", columns) as w:
+            print(STR_1UP + "dumping calendar data")
+            for service_id, mask, service_desc in self.service_masks.values():
+                dates = self.calendar_engine.active_dates(mask)
 
-                        if OUTPUT_SERVICE_DESC:
-                            row["service_desc"] = service_desc
+                if self.columnar is not None:
+                    self.columnar.add_service_dates(service_id, dates)
 
-                        w.writerow(row)
+                if OUTPUT_SERVICE_DESC:
+                    w.writerows((service_id, service_desc, i, 1) for i in dates)
+                else:
+                    w.writerows((service_id, i, 1) for i in dates)
 
-                    current_day += timedelta(days=1)
+        self.untenbi_cache.save()
 
     def feed_info(self):
         """Create feed_info.txt
         """
-        with open("gtfs/feed_info.txt", mode="w", encoding="utf8", newline="") as f:
-            w = csv.writer(f)
-
-            w.writerow(["feed_publisher_name", "feed_publisher_url", "feed_lang", "feed_version"])
-            w.writerow([
+        with self.writer.table("feed_info.txt", ["feed_publisher_name", "feed_publisher_url",
+                                                 "feed_lang", "feed_version"]) as w:
+            w.writerow((
                 "HokkaidoRailGTFS",
                 "https://github.com/MKuranowski/HokkaidoRailGTFS",
                 "ja",
                 datetime.now(tz=pytz.timezone("Asia/Tokyo")).strftime("%Y%m%d_%H%M%S")
-            ])
+            ))
 
-    @staticmethod
-    def compress():
-        with zipfile.ZipFile("hokkaidorail.zip", "w", zipfile.ZIP_DEFLATED) as arch:
-            for entry in os.scandir("gtfs"):
-                if entry.name.endswith(".txt"):
-                    arch.write(entry.path, entry.name)
+    def write_diff(self):
+        """Save the differences between this and the previous build
+        """
+        self.feed_diff.save(self.diff_path)
+
+    def write_columnar(self):
+        """Export the columnar copy of the feed
+        """
+        self.columnar.save(self.columnar_path)
+
+    def compress(self):
+        """Finish writing the output zip file
+        """
+        self.writer.close()
+
+        for stats in self.writer.stats():
+            print("  " + stats)
 
     # CONVERTING TRAINS TO GTFS #
 
     def load_routes_info(self):
         """Load data/routes.yaml
         """
-        with open("data/routes.yaml", "r", encoding="utf8") as f:
+        with open(self.routes_file, "r", encoding="utf8") as f:
             ext_data = yaml.safe_load(f)
             self.routes = ext_data["routes"]
             self.expresses = ext_data["expresses"]
 
+        # RouteSplitter of every split route (None for other routes)
+        self.splitters = [RouteSplitter(route) if route["split"] is True else None
+                          for route in self.routes]
+
     def load_type_translation(self):
         """Load data/type_translation.csv
         """
@@ -717,124 +813,89 @@ class HokkaidoRailGTFS:
                 self.type_translation[row["name_ja"]] = row["name_en"], row["name_kana"]
 
     def open_sched_files(self):
-        """Open routes.txt, trips.txt & stop_times.txt,
-        and create csv.DictWriters wrapped around those files.
+        """Open routes.txt, trips.txt, stop_times.txt & shapes.txt.
+        All of them get TableWriters, taking rows as tuples.
         """
-        self.file_routes = open("gtfs/routes.txt", "w", encoding="utf8", newline="")
-        self.file_trips = open("gtfs/trips.txt", "w", encoding="utf8", newline="")
-        self.file_times = open("gtfs/stop_times.txt", "w", encoding="utf8", newline="")
-
-        self.wrtr_routes = csv.DictWriter(
-            self.file_routes,
-            ["agency_id", "route_id", "route_short_name", "route_long_name",
-             "route_type", "route_color", "route_text_color"]
-        )
-
-        self.wrtr_trips = csv.DictWriter(
-            self.file_trips,
-            ["route_id", "trip_id", "service_id", "trip_headsign",
-             "trip_short_name", "direction_id", "block_id", "shape_id"]
-        )
-
-        self.wrtr_times = csv.DictWriter(
-            self.file_times,
-            ["trip_id", "stop_sequence", "stop_id", "arrival_time", "departure_time"]
-        )
-
-        self.wrtr_routes.writeheader()
-        self.wrtr_trips.writeheader()
-        self.wrtr_times.writeheader()
+        # stop_times.txt is opened first, so that it's the one streamed directly into the zip
+        self.wrtr_times = self.writer.table("stop_times.txt", STOP_TIME_COLUMNS)
+        self.wrtr_trips = self.writer.table("trips.txt", TRIP_COLUMNS)
+        self.wrtr_shapes = self.writer.table("shapes.txt", SHAPE_COLUMNS)
+        self.wrtr_routes = self.writer.table("routes.txt", ROUTE_COLUMNS)
 
     def close_sched_files(self):
-        """Close routes.txt, trips.txt & stop_times.txt
+        """Close routes.txt, trips.txt, stop_times.txt & shapes.txt
         """
-        self.file_routes.close()
-        self.file_times.close()
-        self.file_trips.close()
+        self.wrtr_routes.close()
+        self.wrtr_times.close()
+        self.wrtr_trips.close()
+        self.wrtr_shapes.close()
 
         self.wrtr_routes = None
         self.wrtr_trips = None
         self.wrtr_times = None
+        self.wrtr_shapes = None
 
-    def get_trip_headsign(self, train_type, train_name, train_name_suffix, dest):
-        """Given some information about a train generate
-        and return the trip_headsign.
-        Headsign translations are also handled.
+    def write_route(self, gtfs_route):
+        """Write a route, given as a dict with ROUTE_COLUMNS keys, to routes.txt
         """
-        try:
-            type_en, type_kana = self.type_translation[train_type]
-        except KeyError:
-            warn(STR_WARN + f"Missing translation for train type {train_type!r}" + STR_RESET)
-            type_en, type_kana = "", ""
-
-        try:
-            name_en, name_kana = self.type_translation[train_name]
-        except KeyError:
-            warn(STR_WARN + f"Missing translation for train name {train_name!r}" + STR_RESET)
-            name_en, name_kana = "", ""
-
-        dest_en = self.to_english[dest]
-        dest_kana = self.to_kana[dest]
+        self.wrtr_routes.writerow(tuple(gtfs_route[i] for i in ROUTE_COLUMNS))
 
-        if train_type == train_name:
-            ja_headsign = f"（{train_type}）"
-            en_headsign = f" ({type_en}) "
-            kana_headsign = f"（{type_kana}）"
-
-        elif train_name_suffix:
-            ja_headsign = f'（{train_type}「{train_name}{train_name_suffix}」）'
-            en_headsign = f' ({type_en} "{name_en} {train_name_suffix}") '
-            kana_headsign = f'（{type_kana}「{name_kana}{train_name_suffix}」）'
-
-        else:
-            ja_headsign = f'（{train_type}「{train_name}」）'
-            en_headsign = f' ({type_en} "{name_en}") '
-            kana_headsign = f'（{type_kana}「{name_kana}」）'
-
-        ja_headsign += dest
-        en_headsign += dest_en
-        kana_headsign += dest_kana
-
-        self.to_kana[ja_headsign] = kana_headsign
-        self.to_english[ja_headsign] = en_headsign
-
-        return ja_headsign
-
-    def convert_to_gtfs(self, train):
-        """Given a train (as yielded by get_trains()), convert it to
-        GTFS. route_id is not added to the trip entry.
-        Returns (gtfs_trip, list_of_gtfs_stop_times).
+    def write_trip(self, gtfs_trip, gtfs_times):
+        """Write a trip and its stop_times, as returned by convert_to_gtfs(),
+        to trips.txt and stop_times.txt
+        """
+        rows = [(trip_id, seq, stop_id, format_time(arr), format_time(dep), dist)
+                for trip_id, seq, stop_id, arr, dep, dist in gtfs_times]
+
+        self.wrtr_trips.writerow(tuple(gtfs_trip.get(i, "") for i in TRIP_COLUMNS))
+        self.wrtr_times.writerows(rows)
+
+        if self.feed_diff is not None:
+            self.feed_diff.add(gtfs_trip, gtfs_trip["service_desc"],
+                               [(i[2], i[3], i[4]) for i in rows])
+
+        if self.columnar is not None:
+            self.columnar.add_trip(gtfs_trip, gtfs_times)
+
+    def convert_to_gtfs(self, train, route_id):
+        """Given a train (as yielded by get_trains()) and its route_id, convert it to
+        GTFS.
+        Returns (gtfs_trip, list_of_gtfs_stop_times), where stop times
+        are tuples in the order of STOP_TIME_COLUMNS.
+        Arrival and departure times are kept as seconds since midnight,
+        they're only formatted by write_trip().
         """
-        gtfs_trip = {}
-        gtfs_times = []
+        gtfs_trip = {"route_id": route_id}
+        stop_ids = []
 
         # service_id
-        service_id = self.services.get(train["active_days"])
+        gtfs_trip["service_id"] = self.get_service_id(train.active_days)
+        gtfs_trip["service_desc"] = train.active_days
 
-        if service_id is None:
-            service_id = len(self.services)
-            self.services[train["active_days"]] = service_id
+        # trip_id, formatted once for all stop_times
+        if self.stable_ids:
+            trip_id = self.trip_ids.make(f"{route_id}_{train.trip_number}_{train.dir}_",
+                                         train.active_days)
 
-        gtfs_trip["service_id"] = service_id
-
-        # trip_id
-        trip_id = self.trip_enumerator
-        self.trip_enumerator += 1
+        else:
+            trip_id = str(self.trip_enumerator)
+            self.trip_enumerator += 1
 
         gtfs_trip["trip_id"] = trip_id
 
         # block_id
-        first_trip_station = train["stations"][0]["sta"], train["stations"][0]["dep"]
-        last_trip_station = train["stations"][-1]["sta"], train["stations"][-1]["arr"]
-        block_hash = (*train["first_station"], *train["last_station"])
+        first_trip_station = train.stations[0].sta, train.stations[0].dep
+        last_trip_station = train.stations[-1].sta, train.stations[-1].arr
+        block_hash = (*train.first_station, *train.last_station)
 
-        if first_trip_station != train["first_station"] \
-                or last_trip_station != train["last_station"]:
+        if first_trip_station != train.first_station \
+                or last_trip_station != train.last_station:
 
             block_id = self.blocks.get(block_hash)
 
             if block_id is None:
-                block_id = len(self.blocks)
+                block_id = self.block_ids.make("", *block_hash) if self.stable_ids \
+                    else len(self.blocks)
                 self.blocks[block_hash] = block_id
 
         else:
@@ -843,39 +904,48 @@ class HokkaidoRailGTFS:
         gtfs_trip["block_id"] = block_id
 
         # Other Data
-        gtfs_trip["trip_headsign"] = self.get_trip_headsign(
-            train["type"], train["trip_name"],
-            train.get("trip_name_suffix", ""), train["last_station"][0]
+        gtfs_trip["trip_headsign"] = self.headsigns.get(
+            train.type, train.trip_name,
+            train.trip_name_suffix, train.last_station[0]
         )
 
-        gtfs_trip["direction_id"] = train["dir"]
-        gtfs_trip["trip_short_name"] = train.get("trip_number", "")
+        gtfs_trip["direction_id"] = train.dir
+        gtfs_trip["trip_short_name"] = train.trip_number
 
-        # Stop times
-        for idx, stoptime in enumerate(train["stations"]):
+        # Stop IDs
+        for stoptime in train.stations:
 
             # stop_id
-            if train["type"] == "バス":
-                stop_id = self.bus_stops.get(stoptime["sta"])
+            if train.type == "バス":
+                stop_id = self.bus_stops.get(stoptime.sta)
 
                 if stop_id is None:
                     stop_id = -1
-                    warn(f"!!! missing bus stop with name {stoptime['sta']}")
+                    warn(f"!!! missing bus stop with name {stoptime.sta}")
 
             else:
-                stop_id = self.rail_stations.get(stoptime["sta"])
+                stop_id = self.rail_stations.get(stoptime.sta)
 
                 if stop_id is None:
                     stop_id = -1
-                    warn(f"!!! missing rail station with name {stoptime['sta']}")
-
-            gtfs_times.append({
-                "trip_id": trip_id,
-                "stop_sequence": idx,
-                "stop_id": stop_id,
-                "arrival_time": str(stoptime["arr"]),
-                "departure_time": str(stoptime["dep"]),
-            })
+                    warn(f"!!! missing rail station with name {stoptime.sta}")
+
+            stop_ids.append(stop_id)
+
+        # Stop pattern, shape_id & shape_dist_traveled
+        shaper = self.bus_shaper if train.type == "バス" else self.train_shaper
+        pattern = self.stop_patterns.get(tuple(stop_ids),
+                                         lambda i: self.make_shape(shaper, i))
+
+        gtfs_trip["pattern_id"] = pattern.id
+        gtfs_trip["shape_id"] = pattern.shape_id
+        dists = pattern.dists or [""] * len(stop_ids)
+
+        # Stop times
+        gtfs_times = [
+            (trip_id, idx, stop_id, stoptime.arr, stoptime.dep, dist)
+            for idx, (stoptime, stop_id, dist) in enumerate(zip(train.stations, stop_ids, dists))
+        ]
 
         return gtfs_trip, gtfs_times
 
@@ -886,103 +956,69 @@ class HokkaidoRailGTFS:
 
         print("")
 
-        for route in self.routes:
+        for route, splitter in zip(self.routes, self.splitters):
             used_routes = set()
 
             if route.get("split") is True:
+                parts = split_parts(route)
                 print(STR_1UP
-                      + f"Parsing routes {route['route_a']['id']} & {route['route_b']['id']} "
-                      f"({route['route_a']['name_en']!r} & {route['route_b']['name_en']!r})",
+                      + f"Parsing routes {' & '.join(str(i['id']) for i in parts)} "
+                      f"({' & '.join(repr(i['name_en']) for i in parts)})",
                       end="\n\n")
             else:
                 print(STR_1UP + f"Prasing route {route['id']} ({route['name_en']!r})", end="\n\n")
 
+            # The up timetable is only loaded once all down trains are converted
             print(STR_1UP + "Scraping jrhokkaidonorikae.com pages")
-            trains = chain(self.get_trains(route["web_down"], 0),
-                           self.get_trains(route["web_up"], 1))
+            trains = chain.from_iterable(self.get_trains(ttable_id, dir_id) for ttable_id, dir_id
+                                         in ((route["web_down"], 0), (route["web_up"], 1)))
 
             # Prase trains
             for train in trains:
                 # Filter out trains we get from express timetables
-                if train["trip_name"] in ignore_names:
+                if train.trip_name in ignore_names:
                     continue
 
-                print(STR_1UP + f"Train no: {train.get('trip_number', '')}")
+                print(STR_1UP + f"Train no: {train.trip_number}")
 
                 # Filter out some stations
                 if "exclude" in route:
-                    train["stations"] = [i for i in train["stations"]
-                                         if i["sta"] not in route["exclude"]]
+                    train.set_stations([i for i in train.stations
+                                        if i.sta not in route["exclude"]])
 
                 if route["split"] is True:
-                    part_a, part_b = split_train(train, route["split_at"],
-                                                 route["route_a"]["id_station"],
-                                                 route["route_b"]["id_station"])
-
-                    # Filter parts _only_ between Sapporo and Shiroishi and Tomakomai-Numanohata
-                    # Those are stubs left out by Hakodate-Chitose line through service and
-                    # Muroran Oiwake-Tomakomai-Itoi through train
-                    if part_a is not None \
-                            and {part_a["stations"][0]["sta"], part_a["stations"][-1]["sta"]} \
-                            in [{"札幌", "白石"}, {"苫小牧", "沼ノ端"}]:
-
-                        part_a = None
+                    split = splitter.split(train)
 
-                    elif part_b is not None \
-                            and {part_b["stations"][0]["sta"], part_b["stations"][-1]["sta"]} \
-                            in [{"札幌", "白石"}, {"苫小牧", "沼ノ端"}]:
+                    # Convert parts belonging to each of the routes
+                    for gtfs_route, part in zip(split_parts(route), split):
+                        if part is None or len(part.stations) == 0:
+                            continue
 
-                        part_b = None
+                        route_id = gtfs_route["id"]
 
-                    # Convert part blonging to route a
-                    if part_a is not None and len(part_a["stations"]) > 0:
-                        trip, times = self.convert_to_gtfs(part_a)
-                        route_id = route["route_a"]["id"]
-
-                        if part_a["type"] == "バス":
+                        if part.type == "バス":
                             route_id += 100
 
-                        trip["route_id"] = route_id
+                        trip, times = self.convert_to_gtfs(part, route_id)
                         used_routes.add(route_id)
 
                         # write to GTFS
-                        self.wrtr_trips.writerow(trip)
-                        self.wrtr_times.writerows(times)
-
-                    # Convert part belonging to route b
-                    if part_b is not None and len(part_b["stations"]) > 0:
-                        trip, times = self.convert_to_gtfs(part_b)
-                        route_id = route["route_b"]["id"]
-
-                        if part_b["type"] == "バス":
-                            route_id += 100
+                        self.write_trip(trip, times)
 
-                        trip["route_id"] = route_id
-                        used_routes.add(route_id)
-
-                        # write to GTFS
-                        self.wrtr_trips.writerow(trip)
-                        self.wrtr_times.writerows(times)
+                elif len(train.stations) > 0:
+                    # route_id
+                    route_id = route["id"] + 100 if train.type == "バス" else route["id"]
+                    used_routes.add(route_id)
 
-                elif len(train["stations"]) > 0:
                     # convert train data to GTFS
-                    trip, times = self.convert_to_gtfs(train)
-
-                    # route_id
-                    if train["type"] == "バス":
-                        trip["route_id"] = route["id"] + 100
-                        used_routes.add(route["id"] + 100)
-                    else:
-                        trip["route_id"] = route["id"]
-                        used_routes.add(route["id"])
+                    trip, times = self.convert_to_gtfs(train, route_id)
 
                     # write to GTFS
-                    self.wrtr_trips.writerow(trip)
-                    self.wrtr_times.writerows(times)
+                    self.write_trip(trip, times)
 
             # Make all known routes into an iterable
             if route["split"]:
-                known_gtfs_routes = [route["route_a"], route["route_b"]]
+                known_gtfs_routes = split_parts(route)
 
             else:
                 known_gtfs_routes = [route]
@@ -992,7 +1028,7 @@ class HokkaidoRailGTFS:
                 txt_color = get_text_color(gtfs_route["color"])
 
                 if gtfs_route["id"] in used_routes:
-                    self.wrtr_routes.writerow({
+                    self.write_route({
                         "agency_id": gtfs_route.get("agency", DEFAULT_AGENCY),
                         "route_id": gtfs_route["id"],
                         "route_short_name": gtfs_route["name"],
@@ -1010,7 +1046,7 @@ class HokkaidoRailGTFS:
 
                 if gtfs_route["id"] + 100 in used_routes:
                     repl_desc = "【バス代行】" + gtfs_route["desc"]
-                    self.wrtr_routes.writerow({
+                    self.write_route({
                         "agency_id": gtfs_route.get("agency", DEFAULT_AGENCY),
                         "route_id": gtfs_route["id"] + 100,
                         "route_short_name": gtfs_route["name"],
@@ -1041,7 +1077,7 @@ class HokkaidoRailGTFS:
             for name in train["web_names"]:
                 train_name_to_route[name] = train["id"]
 
-            self.wrtr_routes.writerow({
+            self.write_route({
                 "agency_id": train.get("agency", DEFAULT_AGENCY),
                 "route_id": train["id"],
                 "route_short_name": train["name"],
@@ -1057,7 +1093,8 @@ class HokkaidoRailGTFS:
             self.to_kana[train["desc"]] = train["desc_kana"]
             self.to_english[train["desc"]] = train["desc_en"]
 
-            self.type_translation[train["name"]] = train["name_en"], train["name_kana"]
+            self.headsigns.add_type_translation(train["name"], train["name_en"],
+                                                train["name_kana"])
 
         print(STR_1UP + "Scraping jrhokkaidonorikae.com pages")
         down_trains = (t for r in self.expresses["web_down"] for t in self.get_trains(r, 0))
@@ -1065,67 +1102,257 @@ class HokkaidoRailGTFS:
 
         # Dump train data
         for train in chain(down_trains, up_trains):
-            if train["trip_name"] == "普通" or len(train["stations"]) == 0:
+            if train.trip_name == "普通" or len(train.stations) == 0:
                 continue
 
-            print(STR_1UP + f"Train no: {train['trip_number']}")
+            print(STR_1UP + f"Train no: {train.trip_number}")
 
             # route_id
-            route_id = train_name_to_route.get(train["trip_name"])
+            route_id = train_name_to_route.get(train.trip_name)
 
             if route_id is None:
-                raise ValueError(f"unrecognized express train {train['trip_name']!r}"
+                raise ValueError(f"unrecognized express train {train.trip_name!r}"
                                  "make sure it is present in data/routes.yaml → expresses")
 
-            train["type"] = "特急"
+            train.type = "特急"
 
-            gtfs_trip, gtfs_times = self.convert_to_gtfs(train)
-            gtfs_trip["route_id"] = route_id
+            gtfs_trip, gtfs_times = self.convert_to_gtfs(train, route_id)
 
-            self.wrtr_trips.writerow(gtfs_trip)
-            self.wrtr_times.writerows(gtfs_times)
+            self.write_trip(gtfs_trip, gtfs_times)
+
+    def timetable_ids(self):
+        """Return (timetable_id, direction_id) of all timetables used by
+        trains_normal() and trains_express(), in the order in which they are going to be parsed.
+        """
+        for route in self.routes:
+            yield route["web_down"], 0
+            yield route["web_up"], 1
+
+        yield from ((i, 0) for i in self.expresses["web_down"])
+        yield from ((i, 1) for i in self.expresses["web_up"])
+
+    def trains_parallel(self):
+        """Run trains_normal() & trains_express(), with upcoming timetables
+        parsed in a pool of self.processes worker processes (see fill_pipeline()).
+
+        Only parsing is done by the workers. Trains are converted to GTFS
+        (and get their trip, service and block IDs) in the main process,
+        in the same order as in a serial run, so the output is exactly the same.
+        """
+        with ProcessPoolExecutor(self.processes) as pool:
+            self.pool = pool
+            try:
+                self.trains_normal()
+                self.trains_express()
+
+            finally:
+                self.pool = None
+                for _, _, future in self.parsing.values():
+                    if future is not None:
+                        future.cancel()
+                self.parsing.clear()
 
     def trains(self):
-        """Create gtfs/trips.txt and gtfs/stop_times.txt from jrhokkaidonorike.com"""
+        """Create trips.txt and stop_times.txt from jrhokkaidonorike.com"""
         self.load_routes_info()
         self.load_type_translation()
 
+        self.timetable_parser = TimetableParser(self.calendar_data.get("section_changing"))
+
+        # Pages are downloaded concurrently, but converted one-by-one in the original order,
+        # so that trip_ids and block_ids don't depend on download (or parsing) timing.
+        # fetch → parse → convert → write is a pipeline: get_trains() pulls pages through it,
+        # with at most pages_in_flight of them waiting, so memory doesn't grow with their count.
+        self.upcoming = iter(self.timetable_ids())
+        self.in_flight.clear()
+
         self.open_sched_files()
         try:
-            self.trains_normal()
-            self.trains_express()
+            if self.processes > 1:
+                self.trains_parallel()
+            else:
+                self.trains_normal()
+                self.trains_express()
+
+            print(STR_1UP + self.stop_patterns.report())
+            print(self.headsigns.report(), end="\n\n")
+
+            if self.timetable_store is not None:
+                self.timetable_store.prune()
+
         finally:
+            self.upcoming = None
             self.close_sched_files()
+            self.fetcher.close()
+
+    # MEASUREMENTS #
+
+    def counters(self):
+        """Return counters tracked for every stage by self.metrics"""
+        return {
+            "rows": sum(i.rows for i in self.writer.tables),
+            "bytes_written": sum(i.bytes for i in self.writer.tables),
+            "requests": self.fetcher.requests,
+            "bytes_downloaded": self.fetcher.bytes_downloaded,
+        }
+
+    def run_stage(self, name):
+        """Call the `name` method, measuring it (and profiling, if it was selected)"""
+        with self.metrics.stage(name, profile=name == self.profile_stage):
+            getattr(self, name)()
+
+    def save_metrics(self):
+        """Write the JSON report of the run to self.metrics_path"""
+        self.metrics.add_time("download", self.fetcher.download_seconds)
+        self.metrics.add_time("writing", sum(i.seconds for i in self.writer.tables))
+
+        self.metrics.save(self.metrics_path, tables={
+            i.name: {"rows": i.rows, "bytes": i.bytes, "seconds": round(i.seconds, 4)}
+            for i in self.writer.tables
+        })
 
     # AUTO-PARSING #
 
     @classmethod
-    def parse(cls):
-        self = cls()
+    def parse(cls, **kwargs):
+        self = cls(**kwargs)
 
         print("agency")
-        self.agency()
+        self.run_stage("agency")
 
         print("stops")
-        self.stops()
+        self.run_stage("stops")
+
+        print("preparing shapes")
+        self.run_stage("prepare_shapes")
 
         print("loading calendars.yaml")
-        self.load_calendar_data()
+        self.run_stage("load_calendar_data")
+
+        print("requesting list of holidays")
+        self.run_stage("prepare_calendars")
 
         print("trains")
-        self.trains()
+        self.run_stage("trains")
 
         print(STR_1UP + "calendars", end="\n\n")
-        self.calendars()
+        self.run_stage("calendars")
 
         print(STR_1UP + "translations")
-        self.translations()
+        self.run_stage("translations")
 
         print("feed_info")
-        self.feed_info()
+        self.run_stage("feed_info")
+
+        print("saving the output zip file")
+        self.run_stage("compress")
+
+        if self.feed_diff is not None:
+            print("comparing trips with the previous build")
+            self.run_stage("write_diff")
+
+        if self.columnar is not None:
+            print(f"exporting columnar feed to {self.columnar_path}")
+            self.run_stage("write_columnar")
 
-        print("saving to hokkaidorail.zip")
-        self.compress()
+        if self.metrics_path:
+            self.save_metrics()
 
 if __name__ == "__main__":
-    HokkaidoRailGTFS.parse()
+    arg_parser = argparse.ArgumentParser(description="Create GTFS for JR Hokkaido")
+
+    arg_parser.add_argument(
+        "--workers", type=int, default=4, dest="max_workers",
+        help="maximum amount of timetable pages downloaded at once (default: 4)")
+
+    arg_parser.add_argument(
+        "--rate-limit", type=float, default=5, dest="max_per_second",
+        help="maximum amount of requests per second to a single host (default: 5)")
+
+    arg_parser.add_argument(
+        "--cache-dir", default=None,
+        help="directory where downloaded pages are cached (default: no caching)")
+
+    arg_parser.add_argument(
+        "--cache-ttl", type=float, default=0,
+        help="seconds for which cached pages are used without revalidation (default: 0)")
+
+    arg_parser.add_argument(
+        "--cache-max-size", type=float, default=100,
+        help="maximum size of the cache in MiB (default: 100)")
+
+    arg_parser.add_argument(
+        "--offline", action="store_true",
+        help="only use pages from --cache-dir, never connect to the network")
+
+    arg_parser.add_argument(
+        "--untenbi-parser", choices=UNTENBI_PARSERS, default="fast",
+        help="parser used for service descriptions: the hand-written 'fast' one (default), "
+             "the 'parsec' grammar, or 'check' to run both and fail if they disagree")
+
+    arg_parser.add_argument(
+        "--vtime-url", default=VTIME_URL,
+        help="URL of timetable pages, e.g. of a local stand-in for jrhokkaidonorikae.com")
+
+    arg_parser.add_argument(
+        "--holidays-url", default=HOLIDAYS_URL,
+        help="URL of the CSV file with Japanese holidays")
+
+    arg_parser.add_argument(
+        "--diff-state", default=None, metavar="PATH",
+        help="file with trips of the previous build; if given, changes to trips are saved "
+             "next to the zip file, as OUTPUT.diff.json, and PATH is updated")
+
+    arg_parser.add_argument(
+        "--ids", choices=ID_STRATEGIES, default="sequential",
+        help="how trip_id, service_id and block_id are generated: numbered in order "
+             "(sequential, default) or derived from content, unchanged between builds (stable)")
+
+    arg_parser.add_argument(
+        "--sqlite", action="store_true",
+        help="also load the feed into an SQLite database next to the zip file, "
+             "as OUTPUT.sqlite; see sqlitefeed.py for querying it")
+
+    arg_parser.add_argument(
+        "--columnar", choices=COLUMNAR_FORMATS, default=None,
+        help="also export trips, stop_times and calendar_dates as columns, next to the zip "
+             "file: a NumPy .npz file (npz), or Arrow (arrow) or Parquet (parquet) files")
+
+    arg_parser.add_argument(
+        "--pages-in-flight", type=int, default=8, metavar="N",
+        help="how many timetable pages can be downloaded (or parsed) ahead of the one "
+             "being converted (default: 8)")
+
+    arg_parser.add_argument(
+        "--routes-file", default="data/routes.yaml", metavar="PATH",
+        help="file with routes and timetables to convert (default: data/routes.yaml)")
+
+    arg_parser.add_argument(
+        "--processes", type=int, default=1,
+        help="amount of worker processes parsing timetable pages (default: 1, no workers)")
+
+    arg_parser.add_argument(
+        "--metrics", default=None, metavar="PATH",
+        help="save timings and sizes of all stages, and peak memory usage, to a JSON file")
+
+    arg_parser.add_argument(
+        "--profile", choices=STAGES, default=None, metavar="STAGE",
+        help="run a stage under cProfile and tracemalloc; one of: " + ", ".join(STAGES))
+
+    arg_parser.add_argument(
+        "--profile-dir", default=".",
+        help="where STAGE.pstats and STAGE.memory.txt are saved (default: current directory)")
+
+    arg_parser.add_argument(
+        "-o", "--output", default="hokkaidorail.zip",
+        help="path to the created GTFS zip file (default: hokkaidorail.zip)")
+
+    arg_parser.add_argument(
+        "--compression-level", type=int, choices=range(10), default=None, metavar="0-9",
+        help="deflate compression level of the zip file (default: zlib's default, 6)")
+
+    arg_parser.add_argument(
+        "--keep-dir", nargs="?", const="gtfs", default=None, metavar="DIR",
+        help="also write GTFS tables as plain files to DIR (default DIR: gtfs)")
+
+    HokkaidoRailGTFS.parse(**vars(arg_parser.parse_args()))
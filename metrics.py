@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+from time import perf_counter
+import tracemalloc
+import cProfile
+import json
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peak_rss_mib():
+    """Return the peak resident set size of this process in MiB,
+    or None if it can't be checked on this platform.
+    """
+    if resource is None:
+        return None
+
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+
+class Metrics:
+    """Collects measurements of a HokkaidoRailGTFS run.
+
+    - stages: wall time and changes of `counters` over each stage,
+    - timers: total time spent on specific kinds of work (e.g. untenbi parsing),
+    - timetables: per-timetable records (download size, parsing time, …).
+
+    `counters` is a function returning a dict of monotonically increasing values
+    (like rows written or bytes downloaded); every stage records by how much
+    each of them grew.
+
+    The peak resident set size is only known for the whole process, so it's
+    reported once for the run. A stage can also be profiled with cProfile and tracemalloc;
+    the results are saved into `profile_dir` as STAGE.pstats and STAGE.memory.txt,
+    and the traced memory peak of that stage as its traced_peak_mib.
+    """
+    def __init__(self, counters=None, profile_dir="."):
+        self.counters = counters or dict
+        self.profile_dir = profile_dir
+
+        self.started = perf_counter()
+        self.stages = {}
+        self.timers = {}
+        self.timetables = []
+
+    @contextmanager
+    def stage(self, name, profile=False):
+        """Measure the code run inside the with block as the `name` stage"""
+        counters_before = self.counters()
+        profiler = None
+
+        if profile:
+            tracemalloc.start()
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start = perf_counter()
+
+        try:
+            yield
+
+        finally:
+            seconds = perf_counter() - start
+            counters_after = self.counters()
+
+            self.stages[name] = {
+                "seconds": round(seconds, 4),
+                **{k: v - counters_before.get(k, 0) for k, v in counters_after.items()},
+            }
+
+            if profiler is not None:
+                profiler.disable()
+                self.save_profile(name, profiler)
+
+    def save_profile(self, name, profiler):
+        """Dump cProfile stats and the biggest tracemalloc allocations of a stage"""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(self.profile_dir, name + ".pstats"))
+
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.stages[name]["traced_peak_mib"] = round(peak / 2**20, 2)
+
+        with open(os.path.join(self.profile_dir, name + ".memory.txt"), "w",
+                  encoding="utf8") as f:
+            f.write(f"Peak traced memory: {peak / 2**20:.2f} MiB\n\n")
+
+            for stat in snapshot.statistics("lineno")[:50]:
+                f.write(str(stat) + "\n")
+
+    @contextmanager
+    def timer(self, name):
+        """Add the time spent inside the with block to the `name` timer"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def timetable(self, **record):
+        """Save a record about a single timetable"""
+        self.timetables.append(record)
+
+    def report(self, **extra):
+        """Return all measurements as a JSON-serializable dict"""
+        return {
+            "total_seconds": round(perf_counter() - self.started, 4),
+            "peak_rss_mib": peak_rss_mib(),
+            "stages": self.stages,
+            "timers": {k: round(v, 4) for k, v in self.timers.items()},
+            "timetables": self.timetables,
+            **extra,
+        }
+
+    def save(self, path, **extra):
+        """Write report() to a JSON file"""
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(self.report(**extra), f, indent=2, ensure_ascii=False)
@@ -0,0 +1,105 @@
+import xml.etree.ElementTree as etree
+import hashlib
+import pickle
+import os
+
+class OSMData:
+    """Data loaded from an .osm file:
+
+    - `stops`: list of (node_id, lat, lon, tags) of railway=station and
+      highway=bus_stop nodes, in file order, with lat & lon as written in the file,
+    - `nodes`: maps every node_id to its (lat, lon) as floats,
+    - `ways`: maps every way_id to a tuple (tags, list_of_node_ids).
+    """
+    def __init__(self):
+        self.stops = []
+        self.nodes = {}
+        self.ways = {}
+
+def parse_osm(path):
+    """Stream through an .osm file and return its OSMData.
+    Elements are discarded as soon as they're processed.
+    """
+    data = OSMData()
+    root = None
+
+    for event, elem in etree.iterparse(path, events=("start", "end")):
+        if root is None:
+            root = elem
+
+        if event != "end":
+            continue
+
+        if elem.tag == "node":
+            node_id = elem.attrib["id"]
+            lat, lon = elem.attrib["lat"], elem.attrib["lon"]
+            data.nodes[node_id] = float(lat), float(lon)
+
+            # Only stops need their tags
+            if len(elem):
+                tags = {tag.get("k"): tag.get("v") for tag in elem.iterfind("tag")}
+
+                if tags.get("railway") == "station" or tags.get("highway") == "bus_stop":
+                    data.stops.append((node_id, lat, lon, tags))
+
+        elif elem.tag == "way":
+            tags = {tag.get("k"): tag.get("v") for tag in elem.iterfind("tag")}
+            refs = [nd.get("ref") for nd in elem.iterfind("nd")]
+            data.ways[elem.attrib["id"]] = tags, refs
+
+        else:
+            continue
+
+        # Drop everything parsed so far
+        root.clear()
+
+    return data
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def save_cache(cache_path, stat_key, sha, data):
+    with open(cache_path + ".tmp", "wb") as f:
+        pickle.dump((stat_key, sha, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(cache_path + ".tmp", cache_path)
+
+def load_osm(path, cache_path=None):
+    """Return OSMData of an .osm file.
+
+    If `cache_path` is given, the data is pickled there, together with
+    the file's mtime, size and hash. Later calls read the pickle instead of
+    parsing the file again, as long as the file's mtime and size, or its hash,
+    are unchanged.
+    """
+    stat = os.stat(path)
+    stat_key = stat.st_mtime_ns, stat.st_size
+    sha = None
+
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                cached_stat_key, cached_sha, data = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError, ValueError, AttributeError):
+            cached_stat_key, cached_sha, data = None, None, None
+
+        if cached_stat_key == stat_key:
+            return data
+
+        # The file could have been touched without changing,
+        # remember its new mtime and size so that it's not hashed again next time
+        sha = file_hash(path)
+        if cached_sha == sha:
+            save_cache(cache_path, stat_key, sha, data)
+            return data
+
+    data = parse_osm(path)
+
+    if cache_path is not None:
+        save_cache(cache_path, stat_key, sha or file_hash(path), data)
+
+    return data
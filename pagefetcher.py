@@ -0,0 +1,371 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlencode
+import threading
+import requests
+import hashlib
+import json
+import time
+import os
+
+VTIME_URL = "https://jrhokkaidonorikae.com/vtime/vtime.php"
+
+class RateLimiter:
+    """Spaces out requests made to the same host,
+    so that at most `max_per_second` requests are started every second.
+    """
+    def __init__(self, max_per_second):
+        self.interval = 1 / max_per_second if max_per_second else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        """Block until a request to `host` may be started"""
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+class CacheMissError(Exception):
+    """Raised in offline mode, when a page is not in the cache"""
+    pass
+
+class ResponseCache:
+    """A persistent, content-addressed cache of HTTP responses.
+
+    Bodies are stored as `cache_dir/objects/<sha256 of body>`,
+    and `cache_dir/index.json` maps request keys to those objects
+    together with their ETag and Last-Modified headers.
+
+    Entries younger than `ttl` seconds are served without contacting the server.
+    Once the objects take up more than `max_size` bytes,
+    least recently used entries are evicted.
+
+    Changes to the index are only kept in memory, until save() is called.
+    """
+    def __init__(self, cache_dir, ttl=0, max_size=100 * 2**20):
+        self.dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        os.makedirs(os.path.join(self.dir, "objects"), exist_ok=True)
+
+        try:
+            with open(os.path.join(self.dir, "index.json"), "r", encoding="utf8") as f:
+                self.index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = {}
+
+        # Drop entries whose objects have disappeared
+        self.index = {k: v for k, v in self.index.items()
+                      if os.path.exists(self.object_path(v["sha"]))}
+
+        # Objects may be shared by multiple keys: sha → number of keys using it,
+        # and the total size of all objects
+        self.refs = {}
+        self.total_size = 0
+
+        for entry in self.index.values():
+            self.add_ref(entry)
+
+    def object_path(self, sha):
+        return os.path.join(self.dir, "objects", sha)
+
+    def lookup(self, key):
+        """Return the index entry for `key`, or None"""
+        with self.lock:
+            return self.index.get(key)
+
+    def is_fresh(self, entry):
+        return time.time() - entry["fetched"] < self.ttl
+
+    def conditional_headers(self, entry):
+        """Return headers used to revalidate an entry"""
+        headers = {}
+
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        return headers
+
+    def read(self, key):
+        """Return the cached body for `key`,
+        or None if it was evicted in the meantime (by another thread)
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+
+            entry["accessed"] = time.time()
+            self.dirty = True
+
+            # Objects are only removed with the lock held,
+            # and an opened file can still be read after it's removed
+            try:
+                f = open(self.object_path(entry["sha"]), "rb")
+            except FileNotFoundError:
+                del self.index[key]
+                self.release(entry)
+                return None
+
+        with f:
+            return f.read()
+
+    def revalidated(self, key):
+        """Mark an entry as just confirmed by the server (304 Not Modified).
+        Returns False if the entry was evicted in the meantime (by another thread).
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return False
+
+            entry["fetched"] = time.time()
+            self.dirty = True
+            return True
+
+    def add_ref(self, entry):
+        """Count a new key using the object of `entry`. Has to be called with self.lock held."""
+        if entry["sha"] not in self.refs:
+            self.refs[entry["sha"]] = 0
+            self.total_size += entry["size"]
+
+        self.refs[entry["sha"]] += 1
+
+    def release(self, entry):
+        """Stop counting a key using the object of `entry`, and remove the object
+        once nothing uses it. Has to be called with self.lock held.
+        """
+        self.refs[entry["sha"]] -= 1
+
+        if not self.refs[entry["sha"]]:
+            del self.refs[entry["sha"]]
+            self.total_size -= entry["size"]
+
+            try:
+                os.remove(self.object_path(entry["sha"]))
+            except FileNotFoundError:
+                pass
+
+    def store(self, key, url, body, headers):
+        """Save a response body under `key`"""
+        sha = hashlib.sha256(body).hexdigest()
+        path = self.object_path(sha)
+        now = time.time()
+
+        # evict() removes objects with the lock held, so the object has to be
+        # written and indexed without releasing the lock in between
+        with self.lock:
+            if sha not in self.refs:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(body)
+                os.replace(path + ".tmp", path)
+
+            entry = {
+                "url": url,
+                "sha": sha,
+                "size": len(body),
+                "etag": headers.get("ETag", ""),
+                "last_modified": headers.get("Last-Modified", ""),
+                "fetched": now,
+                "accessed": now,
+            }
+
+            self.add_ref(entry)
+
+            if key in self.index:
+                self.release(self.index[key])
+
+            self.index[key] = entry
+            self.evict()
+            self.dirty = True
+
+    def evict(self):
+        """Remove least recently used entries until objects fit in max_size.
+        Has to be called with self.lock held.
+        """
+        if self.total_size <= self.max_size:
+            return
+
+        for key, entry in sorted(self.index.items(), key=lambda i: i[1]["accessed"]):
+            if self.total_size <= self.max_size:
+                break
+
+            del self.index[key]
+            self.release(entry)
+
+    def save(self):
+        """Write index.json, if anything has changed since it was last written"""
+        with self.lock:
+            if not self.dirty:
+                return
+
+            path = os.path.join(self.dir, "index.json")
+
+            with open(path + ".tmp", "w", encoding="utf8") as f:
+                json.dump(self.index, f, indent=1)
+
+            os.replace(path + ".tmp", path)
+            self.dirty = False
+
+class PageFetcher:
+    """Downloads timetable pages from jrhokkaidonorikae.com.
+
+    Pages can be prefetched, in which case they're requested
+    in a pool of `max_workers` threads, with at most `max_per_second`
+    requests started every second to a single host.
+    Prefetched pages are handed out by timetable(), in whatever order
+    the caller asks for them.
+
+    If `cache` (a ResponseCache) is provided all responses are read through it;
+    and with `offline` set pages are only ever read from the cache.
+
+    Timetables are requested from `vtime_url`, which can point to
+    a local stand-in for jrhokkaidonorikae.com (e.g. for benchmarks).
+
+    The amount of requests, bytes downloaded and time spent downloading are counted,
+    and `timetable_stats` maps every fetched timetable to its size and fetching time.
+    """
+    def __init__(self, max_workers=4, max_per_second=5, cache=None, offline=False,
+                 vtime_url=VTIME_URL):
+        if offline and cache is None:
+            raise ValueError("offline mode requires a response cache")
+
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(max_per_second)
+        self.cache = cache
+        self.offline = offline
+        self.vtime_url = vtime_url
+
+        self.executor = None
+        self.pending = {}
+        self.local = threading.local()
+
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.bytes_downloaded = 0
+        self.download_seconds = 0.0
+        self.timetable_stats = {}
+
+    def session(self):
+        """Return a requests.Session private to the calling thread"""
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def get(self, url, params=None, encoding="utf-8"):
+        """Make a rate-limited GET request and return the response text"""
+        return self.get_bytes(url, params).decode(encoding, errors="replace")
+
+    def get_bytes(self, url, params=None):
+        """Make a rate-limited GET request and return the response body"""
+        if self.cache is None:
+            return self.download(url, params).content
+
+        key = url + "?" + urlencode(params) if params else url
+        entry = self.cache.lookup(key)
+
+        if self.offline:
+            body = self.cache.read(key) if entry is not None else None
+
+            if body is None:
+                raise CacheMissError(f"{key} is not cached")
+
+            return body
+
+        if entry is not None and self.cache.is_fresh(entry):
+            body = self.cache.read(key)
+
+            if body is not None:
+                return body
+
+            # Evicted by another thread since the lookup
+            entry = None
+
+        headers = self.cache.conditional_headers(entry) if entry else {}
+        req = self.download(url, params, headers)
+
+        if req.status_code == 304 and entry is not None:
+            body = self.cache.read(key) if self.cache.revalidated(key) else None
+
+            if body is not None:
+                return body
+
+            # Evicted by another thread since the lookup, download it again
+            req = self.download(url, params)
+
+        self.cache.store(key, url, req.content, req.headers)
+        return req.content
+
+    def download(self, url, params=None, headers=None):
+        """Make a rate-limited GET request and return the response"""
+        self.limiter.wait(urlsplit(url).netloc)
+
+        start = time.perf_counter()
+        req = self.session().get(url, params=params, headers=headers)
+        req.raise_for_status()
+
+        with self.stats_lock:
+            self.requests += 1
+            self.bytes_downloaded += len(req.content)
+            self.download_seconds += time.perf_counter() - start
+
+        return req
+
+    def fetch_timetable(self, ttable_id):
+        """Download the vtime.php page of a given timetable"""
+        start = time.perf_counter()
+        body = self.get_bytes(self.vtime_url, params={"s": ttable_id, "d": "0"})
+
+        with self.stats_lock:
+            self.timetable_stats[ttable_id] = {
+                "bytes": len(body),
+                "seconds": round(time.perf_counter() - start, 4),
+            }
+
+        return body.decode("utf-8", errors="replace")
+
+    def prefetch(self, ttable_ids):
+        """Start downloading all given timetables in the background"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        for ttable_id in ttable_ids:
+            if ttable_id not in self.pending:
+                self.pending[ttable_id] = self.executor.submit(self.fetch_timetable, ttable_id)
+
+    def timetable(self, ttable_id):
+        """Return the vtime.php page of a given timetable.
+        Prefetched pages are returned (and forgotten) once their download completes,
+        other pages are downloaded right away.
+        """
+        future = self.pending.pop(ttable_id, None)
+
+        if future is None:
+            return self.fetch_timetable(ttable_id)
+
+        return future.result()
+
+    def close(self):
+        """Cancel outstanding downloads, stop worker threads and save the cache index"""
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        if self.cache is not None:
+            self.cache.save()
@@ -0,0 +1,130 @@
+# Parts of trains which only run between these pairs of stations are dropped:
+# Sapporo-Shiroishi and Tomakomai-Numanohata are stubs left out by
+# Hakodate-Chitose line through service and Muroran Oiwake-Tomakomai-Itoi through train
+STUB_PARTS = (frozenset({"札幌", "白石"}), frozenset({"苫小牧", "沼ノ端"}))
+
+def split_parts(route):
+    """Return GTFS routes a split route from data/routes.yaml is made of:
+    values of the route_a, route_b, route_c, … keys, in that order.
+    """
+    return [route[key] for key in sorted(route) if key.startswith("route_")]
+
+class RouteSplitter:
+    """Splits trains of a split route from data/routes.yaml into parts
+    belonging to its GTFS routes.
+
+    `split_at` is a station name (or a list of them, for routes made out of
+    more than 2 GTFS routes); trains are cut at every one of them, which they pass
+    through (the first time). `id_station` lists of the GTFS routes decide which part
+    belongs to which route: parts are matched, in order, to the first route not yet
+    used whose id_station they stop at; a part without any id_station
+    gets the only remaining route.
+
+    Everything is precompiled once per route, and split() only does a single pass
+    over the stations of a train.
+    """
+    def __init__(self, route, stubs=STUB_PARTS):
+        self.routes = split_parts(route)
+        self.split_at = route["split_at"] if isinstance(route["split_at"], list) \
+            else [route["split_at"]]
+        self.split_stations = set(self.split_at)
+        self.stubs = stubs
+
+        if len(self.routes) != len(self.split_at) + 1:
+            raise ValueError(f"route split at {self.split_at} should have "
+                             f"{len(self.split_at) + 1} parts, got {len(self.routes)}")
+
+        # station name → indices of routes with that id_station
+        self.id_stations = {}
+        for idx, gtfs_route in enumerate(self.routes):
+            for station in gtfs_route["id_station"]:
+                self.id_stations.setdefault(station, []).append(idx)
+
+    def split(self, train):
+        """Split a train into parts.
+        Returns a list, with the part of the train belonging to each GTFS route
+        (in the same order as self.routes), or None if no part belongs to a route.
+        """
+        stations = train.stations
+        last_idx = len(stations) - 1
+
+        # Single pass: cut points and routes identified by every segment
+        cuts = []
+        matches = [set()]
+        seen_splits = set()
+
+        for idx, stoptime in enumerate(stations):
+            route_indices = self.id_stations.get(stoptime.sta, ())
+            matches[-1].update(route_indices)
+
+            if stoptime.sta in self.split_stations and stoptime.sta not in seen_splits:
+                seen_splits.add(stoptime.sta)
+
+                if 0 < idx < last_idx:
+                    cuts.append(idx)
+                    matches.append(set(route_indices))
+
+        assignment = self.assign(matches)
+
+        if assignment is None:
+            # Airport Express stubs left out on Hakodate line timetables
+            if not cuts and train.trip_name == "エアポート" and len(stations) == 1 \
+                    and stations[0].sta == "札幌":
+                return [None] * len(self.routes)
+
+            raise ValueError(f"train no {train.trip_number} in should stop at one of: "
+                             f"{self.split_at} "
+                             f"{' '.join(str(i['id_station']) for i in self.routes)}. "
+                             "It's impossible to split this train into correct routes.")
+
+        result = [None] * len(self.routes)
+
+        if not cuts:
+            parts = [train]
+
+        else:
+            # The stop at a cut is shared by both parts,
+            # and the train is considered to depart from it at its arrival time
+            for idx in cuts:
+                stations[idx].dep = stations[idx].arr
+
+            parts = []
+            for start, end in zip([0, *cuts], [*cuts, last_idx]):
+                part = train.copy()
+                part.set_stations(stations[start:end + 1])
+                parts.append(part)
+
+        for route_idx, part in zip(assignment, parts):
+            if frozenset((part.stations[0].sta, part.stations[-1].sta)) not in self.stubs:
+                result[route_idx] = part
+
+        return result
+
+    def assign(self, matches):
+        """Given sets of route indices identified by each segment,
+        return the index of the route of every segment, or None if that's ambiguous.
+        """
+        assignment = [None] * len(matches)
+        used = set()
+
+        for idx, matched in enumerate(matches):
+            route_idx = min(matched - used, default=None)
+
+            if route_idx is not None:
+                assignment[idx] = route_idx
+                used.add(route_idx)
+
+        unassigned = [idx for idx, route_idx in enumerate(assignment) if route_idx is None]
+        remaining = [idx for idx in range(len(self.routes)) if idx not in used]
+
+        if len(unassigned) == len(matches):
+            return None
+
+        elif not unassigned:
+            return assignment
+
+        elif len(unassigned) == 1 and len(remaining) == 1:
+            assignment[unassigned[0]] = remaining[0]
+            return assignment
+
+        return None
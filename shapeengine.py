@@ -0,0 +1,209 @@
+from math import radians, sin, cos, asin, sqrt
+import heapq
+
+EARTH_RADIUS = 6_371_000
+
+# Size of cells of the spatial index, in degrees.
+# With MAX_SNAP_DISTANCE below the size of a cell, only the
+# surrounding 3×3 cells have to be searched when snapping stops.
+GRID_CELL = 0.01
+MAX_SNAP_DISTANCE = 500
+
+def distance(a, b):
+    """Return the distance in meters between two (lat, lon) points"""
+    lat1, lon1, lat2, lon2 = map(radians, (*a, *b))
+    h = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(sqrt(h))
+
+def grid_cell(point):
+    return int(point[0] // GRID_CELL), int(point[1] // GRID_CELL)
+
+class Shaper:
+    """Generates shapes for trips along a subset of ways from OSMData.
+
+    `way_filter` is called with tags of every way and should return True
+    for ways vehicles can use. Those ways are turned once into a graph
+    (respecting oneway tags). Every stop is snapped to the closest node of that graph,
+    with a grid used to find nodes around stops not lying on any of the ways.
+    The graph is then contracted, so that it only contains stops, junctions and
+    ends of ways, with edges remembering the nodes they pass through.
+
+    Paths between pairs of stops are memoized; callers should make sure
+    to only ask for the shape of every unique sequence of stops once.
+    Points of shapes aren't kept - callers are expected to write them out right away.
+    """
+    def __init__(self, osm, way_filter, prefix):
+        self.prefix = prefix
+        self.points = osm.nodes
+
+        # node_id → {neighbour_node_id: distance}
+        full_graph = {}
+
+        for tags, refs in osm.ways.values():
+            if not way_filter(tags):
+                continue
+
+            oneway = tags.get("oneway")
+
+            for a, b in zip(refs, refs[1:]):
+                dist = distance(self.points[a], self.points[b])
+                full_graph.setdefault(a, {})
+                full_graph.setdefault(b, {})
+
+                if oneway != "-1":
+                    full_graph[a][b] = dist
+
+                if oneway != "yes":
+                    full_graph[b][a] = dist
+
+        # (lat_cell, lon_cell) → list of node_ids
+        grid = {}
+        for node_id in full_graph:
+            grid.setdefault(grid_cell(self.points[node_id]), []).append(node_id)
+
+        # stop_id → graph node_id (or None)
+        self.snapped = {tags["id"]: self.snap(node_id, full_graph, grid)
+                        for node_id, _, _, tags in osm.stops}
+
+        self.graph = self.contract(full_graph, set(self.snapped.values()))
+
+        # Memoized paths
+        self.paths = {}
+
+        # Amount of created shapes, for generating shape_ids
+        self.shape_count = 0
+
+    def snap(self, node_id, graph, grid):
+        """Return the graph node closest to node_id,
+        or None if there isn't any within MAX_SNAP_DISTANCE.
+        """
+        if node_id in graph:
+            return node_id
+
+        point = self.points[node_id]
+        lat_cell, lon_cell = grid_cell(point)
+        best_dist = MAX_SNAP_DISTANCE
+        best_node = None
+
+        for cell in ((lat_cell + i, lon_cell + j) for i in (-1, 0, 1) for j in (-1, 0, 1)):
+            for candidate in grid.get(cell, []):
+                dist = distance(point, self.points[candidate])
+                if dist <= best_dist:
+                    best_dist = dist
+                    best_node = candidate
+
+        return best_node
+
+    @staticmethod
+    def contract(graph, keep):
+        """Remove nodes which simply continue a way from the graph.
+        Returns a dict key_node_id → {key_node_id: (length, list_of_(node, dist_from_start))}.
+
+        Nodes in `keep`, nodes touching oneway edges, junctions and ends of ways are kept.
+        """
+        neighbours = {i: set() for i in graph}
+        for a, edges in graph.items():
+            for b in edges:
+                neighbours[a].add(b)
+                neighbours[b].add(a)
+
+        key_nodes = {i for i in graph if i in keep or len(neighbours[i]) != 2
+                     or set(graph[i]) != neighbours[i]}
+
+        contracted = {i: {} for i in key_nodes}
+
+        for start in key_nodes:
+            for node, dist in graph[start].items():
+                prev = start
+                trace = [(start, 0.0), (node, dist)]
+
+                # Follow the chain of nodes until another key node
+                while node not in key_nodes:
+                    prev, node = node, next(i for i in graph[node] if i != prev)
+                    dist += graph[prev][node]
+                    trace.append((node, dist))
+
+                if node != start and dist < contracted[start].get(node, (float("inf"),))[0]:
+                    contracted[start][node] = dist, trace
+
+        return contracted
+
+    def path(self, start, end):
+        """Find the shortest path between 2 graph nodes with A*.
+        Returns a list of (key_node_id, dist_from_start), or None if `end` is unreachable.
+        Only nodes of the contracted graph are returned, nodes in between
+        are added by shape() from the traces of edges.
+        """
+        key = start, end
+        if key in self.paths:
+            return self.paths[key]
+
+        end_point = self.points[end]
+        queue = [(distance(self.points[start], end_point), 0.0, start)]
+        came_from = {start: None}
+        dist_to = {start: 0.0}
+        result = None
+
+        while queue:
+            _, dist, node = heapq.heappop(queue)
+
+            if node == end:
+                result = [(end, dist)]
+
+                while came_from[node] is not None:
+                    node = came_from[node]
+                    result.append((node, dist_to[node]))
+
+                result.reverse()
+                break
+
+            if dist > dist_to[node]:
+                continue
+
+            for neighbour, (edge_dist, _) in self.graph[node].items():
+                neighbour_dist = dist + edge_dist
+
+                if neighbour_dist < dist_to.get(neighbour, float("inf")):
+                    dist_to[neighbour] = neighbour_dist
+                    came_from[neighbour] = node
+                    heapq.heappush(queue, (
+                        neighbour_dist + distance(self.points[neighbour], end_point),
+                        neighbour_dist,
+                        neighbour,
+                    ))
+
+        self.paths[key] = result
+        return result
+
+    def shape(self, stop_ids):
+        """Return (shape_id, list_of_dist_traveled_at_each_stop, list_of_points)
+        for a sequence of stops, or None if the stops can't be connected.
+        Points are (lat, lon, dist_traveled) tuples; distances are in kilometers.
+        """
+        nodes = [self.snapped.get(i) for i in stop_ids]
+
+        if None in nodes:
+            return None
+
+        shape = [(nodes[0], 0.0)]
+        stop_dists = [0.0]
+
+        for start, end in zip(nodes, nodes[1:]):
+            path = self.path(start, end)
+
+            if path is None:
+                return None
+
+            base = stop_dists[-1]
+
+            for (a, a_dist), (b, _) in zip(path, path[1:]):
+                shape.extend((node, base + (a_dist + dist))
+                             for node, dist in self.graph[a][b][1][1:])
+
+            stop_dists.append(base + path[-1][1])
+
+        shape_id = f"{self.prefix}{self.shape_count}"
+        self.shape_count += 1
+
+        points = [(*self.points[node], round(dist / 1000, 3)) for node, dist in shape]
+        return shape_id, [round(i / 1000, 3) for i in stop_dists], points
@@ -0,0 +1,165 @@
+from collections import namedtuple
+from contextlib import closing
+from datetime import date, datetime, timedelta
+import argparse
+import sqlite3
+import os
+
+# Rows are inserted with executemany() in batches of this size
+BATCH_ROWS = 10_000
+
+# table → list of indexed column tuples, created after all rows are loaded
+INDEXES = {
+    "stop_times": [("stop_id", "departure_time"), ("trip_id",)],
+    "trips": [("trip_id",), ("service_id",)],
+    "calendar_dates": [("date", "service_id"), ("service_id", "date")],
+    "stops": [("stop_name",)],
+}
+
+Departure = namedtuple("Departure", ["service_date", "departure_time", "stop_id", "trip_id",
+                                     "route_id", "route_short_name", "trip_headsign",
+                                     "trip_short_name"])
+
+class SQLiteFeed:
+    """Loads GTFS tables into an SQLite database.
+
+    Tables are created with the same columns as their .txt counterparts (see FeedWriter.table()),
+    and rows are bulk-loaded with executemany() inside a single transaction.
+    Indexes from INDEXES are created once all rows are loaded.
+
+    The database is built as `path.tmp`, and moved to `path` on close.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+
+        self.db = sqlite3.connect(path + ".tmp", isolation_level=None)
+
+        # The temporary file is thrown away if anything fails, so there's no need for a journal
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("BEGIN")
+
+        # table → (INSERT statement, list of pending rows)
+        self.tables = {}
+
+    @staticmethod
+    def table_name(name):
+        return name[:-4] if name.endswith(".txt") else name
+
+    def create(self, name, columns):
+        """Create a table for the `name` GTFS table (e.g. stop_times.txt)"""
+        table = self.table_name(name)
+        column_list = ", ".join(f'"{i}"' for i in columns)
+
+        self.db.execute(f'CREATE TABLE "{table}" ({column_list})')
+        self.tables[table] = (
+            f'INSERT INTO "{table}" VALUES ({", ".join("?" * len(columns))})',
+            [],
+        )
+
+    def insert(self, name, rows):
+        """Queue rows for the `name` table"""
+        statement, pending = self.tables[self.table_name(name)]
+        pending.extend(rows)
+
+        if len(pending) >= BATCH_ROWS:
+            self.db.executemany(statement, pending)
+            pending.clear()
+
+    def close(self):
+        """Insert remaining rows, create indexes and move the database to self.path"""
+        for statement, pending in self.tables.values():
+            self.db.executemany(statement, pending)
+            pending.clear()
+
+        for table, indexes in INDEXES.items():
+            if table not in self.tables:
+                continue
+
+            for columns in indexes:
+                self.db.execute(f'CREATE INDEX "idx_{table}_{"_".join(columns)}" '
+                                f'ON "{table}" ({", ".join(columns)})')
+
+        self.db.execute("COMMIT")
+        self.db.execute("ANALYZE")
+        self.db.close()
+
+        os.replace(self.path + ".tmp", self.path)
+
+def parse_gtfs_time(value):
+    """Convert a GTFS time (HH:MM:SS, HH can be above 23) into seconds since midnight"""
+    h, m, s = map(int, value.split(":"))
+    return h * 3600 + m * 60 + s
+
+def next_departures(db, station, on=None, after=None, limit=10):
+    """Return up to `limit` Departures from `station` (a stop_name or stop_id),
+    on date `on` (default: today), at or after time `after` (default: now if `on` is today,
+    midnight otherwise) as a datetime.time or a number of seconds since midnight.
+
+    `db` is an sqlite3 connection or a path to a database created by SQLiteFeed.
+    Trips of the previous service day running past midnight are included,
+    and trips ending at `station` are not.
+    """
+    if isinstance(db, str):
+        with closing(sqlite3.connect(db)) as conn:
+            return next_departures(conn, station, on, after, limit)
+
+    now = datetime.now()
+    on = on or now.date()
+
+    if after is None:
+        after = now.time() if on == now.date() else 0
+
+    if not isinstance(after, int):
+        after = after.hour * 3600 + after.minute * 60 + after.second
+
+    departures = []
+
+    # Times of the previous service day are 24 hours later
+    for service_date, min_seconds in ((on, after), (on - timedelta(days=1), after + 86400)):
+        h, rest = divmod(min_seconds, 3600)
+        min_time = f"{h:0>2}:{rest // 60:0>2}:{rest % 60:0>2}"
+
+        rows = db.execute(
+            """
+            SELECT st.departure_time, st.stop_id, t.trip_id, t.route_id, r.route_short_name,
+                   t.trip_headsign, t.trip_short_name
+            FROM stops s
+            JOIN stop_times st ON st.stop_id = s.stop_id AND st.departure_time >= ?
+            JOIN trips t ON t.trip_id = st.trip_id
+            JOIN calendar_dates cd ON cd.service_id = t.service_id AND cd.date = ?
+                                      AND cd.exception_type = 1
+            LEFT JOIN routes r ON r.route_id = t.route_id
+            WHERE (s.stop_name = ? OR s.stop_id = ?)
+              AND st.stop_sequence < (SELECT MAX(stop_sequence) FROM stop_times
+                                      WHERE trip_id = st.trip_id)
+            ORDER BY st.departure_time
+            LIMIT ?
+            """,
+            (min_time, service_date.strftime("%Y%m%d"), station, station, limit),
+        )
+
+        departures.extend(Departure(service_date, *row) for row in rows)
+
+    departures.sort(key=lambda i: parse_gtfs_time(i.departure_time)
+                    - (86400 if i.service_date != on else 0))
+    return departures[:limit]
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Show next departures from a station")
+    arg_parser.add_argument("database", help="database created with hokkaidorail.py --sqlite")
+    arg_parser.add_argument("station", help="stop_name or stop_id")
+    arg_parser.add_argument("--date", type=date.fromisoformat, default=None,
+                            help="date, as YYYY-MM-DD (default: today)")
+    arg_parser.add_argument("--time", type=lambda i: datetime.strptime(i, "%H:%M").time(),
+                            default=None, help="time, as HH:MM (default: now)")
+    arg_parser.add_argument("-n", "--limit", type=int, default=10,
+                            help="amount of departures (default: 10)")
+    args = arg_parser.parse_args()
+
+    for dep in next_departures(args.database, args.station, args.date, args.time, args.limit):
+        print(f"{dep.departure_time}  {dep.route_short_name or dep.route_id:<12} "
+              f"{dep.trip_short_name:<8} {dep.trip_headsign}")
@@ -0,0 +1,31 @@
+import hashlib
+
+ID_STRATEGIES = ("sequential", "stable")
+
+def content_hash(*parts, length=8):
+    """Return a short hex digest of the given values"""
+    data = "\x1f".join(map(str, parts)).encode("utf8")
+    return hashlib.sha1(data).hexdigest()[:length]
+
+class StableIds:
+    """Generates IDs derived from content, so that they stay the same
+    between builds as long as the underlying data doesn't change.
+
+    Every ID is `prefix` followed by a hash of `content`. IDs which are already
+    taken (two trips with the same content, or a hash collision) get a `-N` suffix,
+    with N counting up from 2 in order of appearance.
+    """
+    def __init__(self):
+        self.used = set()
+
+    def make(self, prefix, *content):
+        base = prefix + content_hash(*content)
+        new_id = base
+        suffix = 1
+
+        while new_id in self.used:
+            suffix += 1
+            new_id = f"{base}-{suffix}"
+
+        self.used.add(new_id)
+        return new_id
@@ -0,0 +1,40 @@
+class StopPattern:
+    """A unique sequence of stop_ids visited by trips,
+    together with data derived from it: shape_id and a list of
+    shape_dist_traveled at each stop (None if there's no shape).
+    """
+    __slots__ = ("id", "stop_ids", "shape_id", "dists", "trips")
+
+    def __init__(self, pattern_id, stop_ids, shape):
+        self.id = pattern_id
+        self.stop_ids = stop_ids
+        self.shape_id, self.dists = shape if shape is not None else ("", None)
+        self.trips = 0
+
+class StopPatternRegistry:
+    """Maps tuples of stop_ids to StopPatterns,
+    so that data derived from a sequence of stops is only computed once.
+    """
+    def __init__(self):
+        self.patterns = {}
+        self.trips = 0
+
+    def get(self, stop_ids, make_shape):
+        """Return the StopPattern of a trip visiting `stop_ids` (a tuple).
+        For new patterns, the shape is created by calling make_shape(stop_ids).
+        """
+        pattern = self.patterns.get(stop_ids)
+
+        if pattern is None:
+            pattern = StopPattern(len(self.patterns), stop_ids, make_shape(stop_ids))
+            self.patterns[stop_ids] = pattern
+
+        pattern.trips += 1
+        self.trips += 1
+        return pattern
+
+    def report(self):
+        """Return a summary of how many trips share stop patterns"""
+        ratio = self.trips / len(self.patterns) if self.patterns else 0
+        return f"{self.trips} trips use {len(self.patterns)} stop patterns " \
+            f"({ratio:.2f} trips per pattern)"
@@ -0,0 +1,262 @@
+from html.parser import HTMLParser
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# Divs of a vtime.php page which contain timetable data
+TABLE_DIVS = {"ekidoriHeader", "timeHeader", "ekidoriBody", "timeBody"}
+
+# Classes of elements, which text is collected into Row.labels
+LABEL_CLASSES = {"item-name", "dep-arv"}
+
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+                 "link", "meta", "param", "source", "track", "wbr"}
+
+# Elements whose contents aren't text of the page
+SKIPPED_ELEMENTS = {"script", "style"}
+
+class Cell:
+    """A single <td> of a timetable table"""
+    __slots__ = ("text", "style", "onclick")
+
+    def __init__(self, text, style, onclick):
+        self.text = text
+        self.style = style
+        self.onclick = onclick
+
+    def __eq__(self, other):
+        return (self.text, self.style, self.onclick) \
+            == (other.text, other.style, other.onclick)
+
+    def __repr__(self):
+        return f"<Cell {self.text!r}>"
+
+class Row:
+    """A single <tr> of a timetable table.
+
+    `cells` is a list of Cell objects, one for each <td> in that row.
+    `labels` maps a class name (from LABEL_CLASSES) to the stripped text of
+    the first element with that class inside this row.
+    """
+    __slots__ = ("cells", "labels")
+
+    def __init__(self):
+        self.cells = []
+        self.labels = {}
+
+    def __eq__(self, other):
+        return self.cells == other.cells and self.labels == other.labels
+
+    def __repr__(self):
+        return f"<Row {self.cells!r} {self.labels!r}>"
+
+class TableCollector:
+    """Receives start/end/data events of a vtime.php page and,
+    in a single pass, collects rows of the TABLE_DIVS and
+    the text of the first div.error-message.
+
+    Text inside <script> and <style> is ignored. Tables nested in a cell
+    don't end the row they're in: their rows and cells aren't collected,
+    and their text becomes part of the outer cell.
+
+    It follows lxml's parser target interface, and is also
+    driven by StdlibTableParser when lxml is not available.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.error = ""
+
+        # Stack of open elements, as (tag, list_of_actions_run_on_close)
+        self.stack = []
+
+        self.table = None
+        self.row = None
+        self.cell_attrs = None
+
+        # Amount of open <table> elements, and how many were open when self.row started
+        self.table_depth = 0
+        self.row_depth = 0
+
+        # Amount of open SKIPPED_ELEMENTS
+        self.skipped = 0
+
+        # Buffers collecting text data
+        self.cell_text = None
+        self.label_text = {}
+        self.error_text = None
+
+    def start(self, tag, attrib):
+        if tag in VOID_ELEMENTS:
+            return
+
+        # Rows and cells of nested tables are only text of the outer cell
+        nested = self.row is not None and self.table_depth > self.row_depth
+
+        # Implicitly close unclosed cells and rows
+        if tag == "td" and self.cell_attrs is not None and not nested:
+            self.end("td")
+        elif tag == "tr" and self.row is not None and not nested:
+            self.end("tr")
+
+        actions = []
+        classes = attrib.get("class", "").split()
+
+        if tag == "table":
+            self.table_depth += 1
+            actions.append("table_depth")
+
+        elif tag in SKIPPED_ELEMENTS:
+            self.skipped += 1
+            actions.append("skipped")
+
+        if tag == "div" and self.table is None and attrib.get("id") in TABLE_DIVS \
+                and attrib["id"] not in self.tables:
+            self.table = self.tables[attrib["id"]] = []
+            actions.append("table")
+
+        elif tag == "div" and "error-message" in classes and self.error_text is None \
+                and not self.error:
+            self.error_text = []
+            actions.append("error")
+
+        if self.table is not None:
+            if tag == "tr" and not nested:
+                self.row = Row()
+                self.row_depth = self.table_depth
+                actions.append("row")
+
+            elif tag == "td" and self.row is not None and not nested:
+                self.cell_attrs = attrib.get("style", ""), attrib.get("onclick", "")
+                self.cell_text = []
+                actions.append("cell")
+
+            if self.row is not None:
+                for cls in classes:
+                    if cls in LABEL_CLASSES and cls not in self.row.labels \
+                            and cls not in self.label_text:
+                        self.label_text[cls] = []
+                        actions.append(cls)
+
+        self.stack.append((tag, actions))
+
+    def end(self, tag):
+        if tag in VOID_ELEMENTS:
+            return
+
+        # Find the element that is being closed
+        for idx in range(len(self.stack) - 1, -1, -1):
+            if self.stack[idx][0] == tag:
+                break
+        else:
+            return
+
+        while len(self.stack) > idx:
+            _, actions = self.stack.pop()
+
+            for action in actions:
+                self.close_action(action)
+
+    def close_action(self, action):
+        if action == "cell":
+            self.row.cells.append(Cell("".join(self.cell_text).strip(), *self.cell_attrs))
+            self.cell_attrs = None
+            self.cell_text = None
+
+        elif action == "row":
+            # Labels of elements left open are finished together with the row
+            for cls in list(self.label_text):
+                self.close_action(cls)
+
+            self.table.append(self.row)
+            self.row = None
+
+        elif action == "table":
+            self.table = None
+
+        elif action == "table_depth":
+            self.table_depth -= 1
+
+        elif action == "skipped":
+            self.skipped -= 1
+
+        elif action == "error":
+            self.error = "".join(self.error_text)
+            self.error_text = None
+
+        elif action in self.label_text:
+            self.row.labels[action] = "".join(self.label_text.pop(action)).strip()
+
+    def data(self, text):
+        if self.skipped:
+            return
+
+        if self.cell_text is not None:
+            self.cell_text.append(text)
+
+        for buffer in self.label_text.values():
+            buffer.append(text)
+
+        if self.error_text is not None:
+            self.error_text.append(text)
+
+    def close(self):
+        # Close elements left open at the end of the document
+        while self.stack:
+            _, actions = self.stack.pop()
+
+            for action in actions:
+                self.close_action(action)
+
+        return self
+
+class StdlibTableParser(HTMLParser):
+    """Feeds events from html.parser into a TableCollector"""
+    def __init__(self, collector):
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
+
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag, {k: v or "" for k, v in attrs})
+
+    def handle_startendtag(self, tag, attrs):
+        self.collector.start(tag, {k: v or "" for k, v in attrs})
+        self.collector.end(tag)
+
+    def handle_endtag(self, tag):
+        self.collector.end(tag)
+
+    def handle_data(self, data):
+        self.collector.data(data)
+
+def extract_tables(page, backend=None):
+    """Extract timetable data from a vtime.php page.
+
+    Returns a TableCollector, whose `tables` maps each of TABLE_DIVS found
+    on the page to a list of its Rows, and `error` contains
+    the text of the page's error message (or an empty string).
+
+    `backend` can be "lxml" or "stdlib"; by default
+    lxml is used if available.
+    """
+    if backend is None:
+        backend = "lxml" if lxml_etree is not None else "stdlib"
+
+    collector = TableCollector()
+
+    if backend == "lxml":
+        parser = lxml_etree.HTMLParser(target=collector)
+        parser.feed(page)
+        parser.close()  # also closes the collector
+
+    elif backend == "stdlib":
+        parser = StdlibTableParser(collector)
+        parser.feed(page)
+        parser.close()
+        collector.close()
+
+    else:
+        raise ValueError(f"unknown table extractor backend: {backend!r}")
+
+    return collector
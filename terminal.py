@@ -0,0 +1,7 @@
+# Escape sequences used in progress and warning messages
+
+STR_1UP = "\033[1A\033[K"
+STR_RED = "\033[31m"
+STR_YELLOW = "\033[33m"
+STR_RESET = "\033[0m"
+STR_WARN = STR_RED + "Warning! " + STR_YELLOW
@@ -0,0 +1,53 @@
+import hashlib
+import pickle
+import os
+
+class TimetableStore:
+    """Keeps parsed timetables on disk, so that pages which haven't changed
+    since the previous run don't have to be parsed again.
+
+    Trains are pickled to `store_dir/<key>.pickle`, where the key is a hash of
+    the page contents and everything else that influences the parsing result.
+    """
+    VERSION = 4
+
+    def __init__(self, store_dir):
+        self.dir = store_dir
+        self.used = set()
+
+        os.makedirs(self.dir, exist_ok=True)
+
+    def key(self, page, *context):
+        """Return the key under which a parsed `page` is stored"""
+        h = hashlib.sha256(repr((self.VERSION, *context)).encode("utf-8"))
+        h.update(page.encode("utf-8"))
+        return h.hexdigest()
+
+    def load(self, key):
+        """Return trains stored under `key`, or None if they weren't stored"""
+        try:
+            with open(os.path.join(self.dir, key + ".pickle"), "rb") as f:
+                trains = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError, ValueError,
+                AttributeError, ImportError):
+            # AttributeError and ImportError: pickled classes which can't be found anymore
+            return None
+
+        self.used.add(key)
+        return trains
+
+    def save(self, key, trains):
+        """Store a list of parsed trains under `key`"""
+        path = os.path.join(self.dir, key + ".pickle")
+
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(trains, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(path + ".tmp", path)
+        self.used.add(key)
+
+    def prune(self):
+        """Remove timetables which weren't used since this store was created"""
+        for entry in os.scandir(self.dir):
+            if entry.name.endswith(".pickle") and entry.name[:-7] not in self.used:
+                os.remove(entry.path)
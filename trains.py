@@ -0,0 +1,96 @@
+from functools import lru_cache
+import sys
+import re
+
+@lru_cache(maxsize=4096)
+def parse_time(string):
+    """Convert a time from jrhokkaidonorikae.com (HHMM or HMM,
+    with any non-digits ignored) to seconds since midnight.
+    Results are cached, as the same cell values repeat all over timetables.
+    """
+    value = re.sub(r"\D", "", string)
+
+    if len(value) == 3:
+        return int(value[0]) * 3600 + int(value[1:]) * 60
+
+    elif len(value) == 4:
+        return int(value[:2]) * 3600 + int(value[2:]) * 60
+
+    else:
+        raise ValueError(f"invalid string for parse_time(), {value} "
+                         f"(should be HHMM or HMM) (passed: {string})")
+
+# HH:MM:00 strings for every full minute of 2 days
+_MINUTE_STRINGS = [f"{h:0>2}:{m:0>2}:00" for h in range(48) for m in range(60)]
+
+def format_time(seconds):
+    """Return GTFS-compliant string representation of
+    the given amount of seconds since midnight.
+    """
+    minutes, s = divmod(seconds, 60)
+
+    if s == 0 and 0 <= minutes < len(_MINUTE_STRINGS):
+        return _MINUTE_STRINGS[minutes]
+
+    h, m = divmod(minutes, 60)
+    return f"{h:0>2}:{m:0>2}:{s:0>2}"
+
+class StopTime:
+    """A train stopping at a station.
+    `arr` and `dep` are in seconds since midnight.
+    """
+    __slots__ = ("sta", "arr", "dep")
+
+    def __init__(self, sta, arr, dep):
+        self.sta = sys.intern(sta)
+        self.arr = arr
+        self.dep = dep
+
+    def __repr__(self):
+        return f"<StopTime {self.sta} {format_time(self.arr)} {format_time(self.dep)}>"
+
+class Train:
+    """A train parsed from jrhokkaidonorikae.com.
+
+    `stations` is a list of StopTimes, and `station_index` maps
+    station names to their index within `stations`.
+    `first_station` and `last_station` are tuples of (station name, seconds since midnight)
+    of the whole train run, which may extend beyond the parsed timetable.
+    """
+    __slots__ = ("stations", "station_index", "dir", "type", "trip_number", "trip_name",
+                 "trip_name_suffix", "first_station", "last_station", "active_days")
+
+    def __init__(self, dir_id):
+        self.stations = []
+        self.station_index = {}
+        self.dir = dir_id
+        self.type = ""
+        self.trip_number = ""
+        self.trip_name = ""
+        self.trip_name_suffix = ""
+        self.first_station = None
+        self.last_station = None
+        self.active_days = None
+
+    def __repr__(self):
+        return f"<Train {self.trip_number} {self.trip_name}>"
+
+    def copy(self):
+        """Return a shallow copy of this train"""
+        new = Train.__new__(Train)
+        for attr in Train.__slots__:
+            setattr(new, attr, getattr(self, attr))
+        return new
+
+    def add_station(self, station, time):
+        """Append a StopTime at `station`, arriving and departing at `time`"""
+        self.station_index[station] = len(self.stations)
+        self.stations.append(StopTime(station, time, time))
+
+    def set_stations(self, stations):
+        """Replace the list of StopTimes and rebuild the station_index"""
+        self.stations = stations
+        self.station_index = {}
+
+        for idx, stoptime in enumerate(stations):
+            self.station_index.setdefault(stoptime.sta, idx)
@@ -1,5 +1,7 @@
 import parsec
+import pickle
 import sys
+import os
 
 # Whole string can start with (土曜・休日|全日運転)(と|。)
 #
@@ -200,7 +202,10 @@ pattern_translate = {
 def parse_untenbi():
     raw_pattern = yield (pattern_def ^ parsec.string(""))
     raw_rules = yield all_rules
+    return interpret_rules(raw_pattern, raw_rules)
 
+def interpret_rules(raw_pattern, raw_rules):
+    """Turn the parsed pattern name and list of rules into the final result dict"""
     result = {}
 
     if raw_pattern:
@@ -255,12 +260,276 @@ def parse_untenbi():
 
     return result
 
+# === HAND-WRITTEN PARSER === #
+#
+# A deterministic, single-pass equivalent of parse_untenbi.
+# Each function below mirrors one of the parsec parsers above:
+# it takes the text and a starting index, and returns
+# a tuple (index_after, value) - or None if the parser would fail.
+#
+# Full-width digits are translated to ASCII upfront,
+# which keeps all indices intact.
+
+full_width_digits = str.maketrans("０１２３４５６７８９", "0123456789")
+
+single_day_rule_types = ["から運転", "からは運転", "からは運休", "まで運転",
+                         "までは運転", "まで運休", "までは運休"]
+
+def fast_number(text, idx):
+    if idx < len(text) and "0" <= text[idx] <= "9":
+        if idx + 1 < len(text) and "0" <= text[idx + 1] <= "9":
+            return idx + 2, int(text[idx:idx + 2])
+        return idx + 1, int(text[idx])
+    return None
+
+def fast_month_day(text, idx):
+    """month_def followed by day_def, returns (index_after, (month, day))"""
+    month = None
+    number = fast_number(text, idx)
+
+    if number is not None and text.startswith("月", number[0]):
+        idx, month = number[0] + 1, number[1]
+        number = fast_number(text, idx)
+
+    if number is None:
+        return None
+
+    idx, day = number
+    if text.startswith("日", idx):
+        idx += 1
+
+    return idx, (month, day)
+
+def fast_date(text, idx):
+    """range_def ^ single_day_def"""
+    start = fast_month_day(text, idx)
+    if start is None:
+        return None
+
+    if text.startswith("～", start[0]):
+        end = fast_month_day(text, start[0] + 1)
+
+        if end is not None:
+            return end[0], {"type": "range", "start": start[1], "end": end[1]}
+
+    return start[0], {"type": "single", "day": start[1]}
+
+def fast_single_day_rule(text, idx):
+    date = fast_month_day(text, idx)
+    if date is None:
+        return None
+
+    idx, day = date
+    for rule_type in single_day_rule_types:
+        if text.startswith(rule_type, idx):
+            if day[0] is None:
+                raise ValueError("month definition is required in から運転・まで運転 rules")
+
+            return idx + len(rule_type), {"day": day, "rule": rule_type_translations[rule_type]}
+
+    return None
+
+def fast_multi_day_rule(text, idx):
+    # sepBy1(date, "・")
+    dates = []
+    date = fast_date(text, idx)
+    if date is None:
+        return None
+
+    while True:
+        idx, value = date
+        dates.append(value)
+
+        if not text.startswith("・", idx):
+            break
+
+        date = fast_date(text, idx + 1)
+        if date is None:
+            break
+
+    # rule_type_def
+    if text.startswith("は", idx):
+        idx += 1
+
+    if text.startswith("運転", idx) or text.startswith("運休", idx):
+        return idx + 2, {
+            "days": flatten_multiple_dates(dates),
+            "rule": rule_type_translations[text[idx:idx + 2]]
+        }
+
+    return None
+
+def fast_rule(text, idx):
+    return fast_single_day_rule(text, idx) or fast_multi_day_rule(text, idx)
+
+def parse_untenbi_fast(text):
+    """Parse a 運転日 description, returning the same dict as parse_untenbi.parse.
+    Raises parsec.ParseError if the description can't be parsed.
+    """
+    original_text, text = text, text.translate(full_width_digits)
+    idx = 0
+    raw_pattern = ""
+
+    # pattern_def ^ parsec.string("")
+    for name in pattern_translate:
+        if text.startswith(name) and text[len(name):len(name) + 1] in {"と", "。"}:
+            raw_pattern = name
+            idx = len(name) + 1
+            break
+
+    # sepEndBy1(rule, one_of("、。"))
+    raw_rules = []
+    rule = fast_rule(text, idx)
+
+    if rule is None:
+        raise parsec.ParseError("parse_untenbi", original_text, idx)
+
+    while rule is not None:
+        idx, value = rule
+        raw_rules.append(value)
+
+        if idx >= len(text) or text[idx] not in "、。":
+            break
+
+        rule = fast_rule(text, idx + 1)
+
+    return interpret_rules(raw_pattern, raw_rules)
+
+# === PARSER SELECTION === #
+
+def parse_untenbi_checked(text):
+    """Parse a 運転日 description with both parsers,
+    raising AssertionError if they disagree.
+    """
+    results = []
+
+    for parser in (parse_untenbi.parse, parse_untenbi_fast):
+        try:
+            results.append(("ok", parser(text)))
+        except parsec.ParseError as e:
+            results.append(("error", e))
+        except (KeyError, ValueError) as e:
+            results.append((type(e).__name__, e))
+
+    (parsec_status, parsec_result), (fast_status, fast_result) = results
+
+    if parsec_status != fast_status or (parsec_status == "ok" and parsec_result != fast_result):
+        raise AssertionError(f"untenbi parsers disagree on {text!r}: "
+                             f"parsec returned {parsec_result!r}, fast returned {fast_result!r}")
+
+    if parsec_status != "ok":
+        raise parsec_result
+
+    return parsec_result
+
+PARSERS = {
+    "fast": parse_untenbi_fast,
+    "parsec": parse_untenbi.parse,
+    "check": parse_untenbi_checked,
+}
+
+# === CACHING === #
+
+# Has to be incremented every time parse_untenbi starts returning different results,
+# so that results cached on disk are discarded
+PARSER_VERSION = 1
+
+class UntenbiCache:
+    """Memoizes parse_untenbi results, including failures.
+
+    If `path` is given, results are loaded from that file and
+    save() writes them back, so that they can be reused between runs.
+    Results are keyed by the raw description, and the whole file is
+    discarded if it was created by a different PARSER_VERSION.
+
+    `parser` selects the function used to parse descriptions from PARSERS.
+
+    Returned dicts are shared between calls and must not be modified.
+    """
+    def __init__(self, path=None, parser="fast"):
+        self.path = path
+        self.parser = PARSERS[parser]
+        self.results = {}
+        self.modified = False
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    version, results = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                version, results = None, {}
+
+            if version == PARSER_VERSION:
+                self.results = results
+
+    def parse(self, text):
+        """Return parse_untenbi.parse(text), raising parsec.ParseError on failures"""
+        try:
+            is_ok, result = self.results[text]
+
+        except KeyError:
+            try:
+                is_ok, result = True, self.parser(text)
+            except parsec.ParseError as e:
+                is_ok, result = False, (e.expected, e.text, e.index)
+
+            self.results[text] = is_ok, result
+            self.modified = True
+
+        if not is_ok:
+            raise parsec.ParseError(*result)
+
+        return result
+
+    def save(self):
+        """Write cached results to self.path, if there's anything new"""
+        if self.path is None or not self.modified:
+            return
+
+        with open(self.path + ".tmp", "wb") as f:
+            pickle.dump((PARSER_VERSION, self.results), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(self.path + ".tmp", self.path)
+        self.modified = False
+
+def compare_parsers(corpus_path):
+    """Run both parsers over every description in a corpus file (one per line),
+    and return the list of descriptions they disagree on.
+    """
+    disagreements = []
+
+    with open(corpus_path, "r", encoding="utf8") as f:
+        for line in f:
+            text = line.rstrip("\n")
+
+            if not text or text.startswith("#"):
+                continue
+
+            try:
+                parse_untenbi_checked(text)
+            except AssertionError:
+                disagreements.append(text)
+            except (parsec.ParseError, KeyError, ValueError):
+                pass
+
+    return disagreements
+
 if __name__ == "__main__":
+    import argparse
     from pprint import pprint
 
-    if len(sys.argv) >= 2:
-        txt = sys.argv[1]
-    else:
-        txt = input("> ")
-
-    pprint(parse_untenbi.parse(txt))
+    arg_parser = argparse.ArgumentParser(description="Parse 運転日 descriptions")
+    arg_parser.add_argument("text", nargs="?", help="description to parse (default: ask)")
+    arg_parser.add_argument("--parser", choices=PARSERS, default="fast")
+    arg_parser.add_argument("--compare", metavar="CORPUS",
+                            help="compare both parsers on a file with descriptions")
+    args = arg_parser.parse_args()
+
+    if args.compare:
+        disagreements = compare_parsers(args.compare)
+        for text in disagreements:
+            print(f"parsers disagree on: {text}")
+        sys.exit(1 if disagreements else 0)
+
+    txt = args.text if args.text else input("> ")
+    pprint(PARSERS[args.parser](txt))